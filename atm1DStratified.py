@@ -7,11 +7,13 @@
 from typing import Tuple, List, NamedTuple
 import bisect
 import numpy as np
-from utils_linalg import multiply, scal_multiply as s_mult
-from utils_linalg import add_banded as add
+from utils_linalg import multiply, BandedMatrix, bands
+from utils_linalg import solve_systems
 from utils_linalg import solve_linear
 from utils_linalg import full_to_half
 from bulk import SurfaceLayerData, friction_scales
+from trajectory import Trajectory
+from checkpoint import Checkpointer
 from universal_functions import Businger_et_al_1971 as businger
 from universal_functions import Large_et_al_2019 as large_ocean
 
@@ -64,6 +66,10 @@ class Atm1dStratified():
         self.C_e: float = 0.34
         self.c_eps: float = 0.845
         self.implicit_coriolis: float = 0.55 # semi-implicit coefficient
+        self.__to_inverse = {} # buffers of __backward_euler (by field)
+        # solver of the momentum and temperature systems, one of
+        # utils_linalg.BACKENDS (None: utils_linalg.COMPLEX_BACKEND)
+        self.backend: str = None
         self.lm_min: float = self.K_min / self.C_m / \
                 np.sqrt(self.e_min)
         self.leps_min: float = self.K_min / self.C_m / \
@@ -121,7 +127,8 @@ class Atm1dStratified():
             sf_scheme: str="FV pure",
             u_delta: float=8.+0j, t_delta: float=265.,
             Neutral_case: bool=False, turbulence: str="TKE",
-            store_all: bool=False):
+            store_all: bool=False,
+            restart: dict=None, checkpoint: Checkpointer=None):
         """
             Integrates in time with Backward Euler the model with TKE
             and Finite volumes.
@@ -141,6 +148,12 @@ class Atm1dStratified():
                 - "KPP" (for simple K-profile parametrization)
             If Neutral_case is True, no temperature profile
             is computed and t_star = 0
+            restart: ret_dict['restart'] of a previous integration
+                (turbulent state at its last time step) to continue
+                it: u_t0, theta_t0,... should then be its last state.
+            checkpoint: saves the state every checkpoint.interval
+                time steps; if it holds a checkpoint, the
+                integration resumes from it.
         """
         assert u_t0.shape[0] == self.M
         assert phi_t0.shape[0] == self.M + 1
@@ -184,12 +197,32 @@ class Atm1dStratified():
         phi, old_phi = phi_t0, np.copy(phi_t0)
         u_current: array = np.copy(u_t0)
         all_u_star, all_t_star = [], []
-        ret_u_current, ret_tke, ret_dz_tke, ret_SL = [], [], [], []
-        ret_tke_bar = []
+        ret_u_current, ret_tke, ret_dz_tke = \
+                Trajectory(), Trajectory(), Trajectory()
+        ret_SL = []
+        ret_tke_bar = Trajectory()
         ret_u_delta, ret_t_delta = [u_delta], [t_delta]
-        ret_phi, ret_theta, ret_dz_theta, ret_leps = [], [], [], []
-
-        for n in range(1,N+1):
+        ret_phi, ret_theta, ret_dz_theta, ret_leps = Trajectory(), \
+                Trajectory(), Trajectory(), Trajectory()
+
+        n_start: int = 1
+        saved = checkpoint.load() if checkpoint is not None else None
+        if saved is not None: # resumes an interrupted integration
+            n_start, restart = saved["n"] + 1, saved["restart"]
+            u_current, phi, theta, dz_theta = saved["prognostic"]
+            u_delta, t_delta, SL = saved["surface"]
+            all_u_star, all_t_star, ret_u_delta, ret_t_delta, ret_SL = \
+                    saved["lists"]
+            (ret_u_current, ret_tke, ret_tke_bar, ret_dz_tke, ret_phi,
+                    ret_theta, ret_dz_theta, ret_leps) = \
+                    saved["trajectories"]
+        if restart is not None: # continues a previous integration
+            tke.tke_full = np.copy(restart["tke"])
+            Ku_full = np.copy(restart["Ku"])
+            Ktheta_full = np.copy(restart["Ktheta"])
+            l_m, l_eps = np.copy(restart["l_m"]), np.copy(restart["l_eps"])
+            old_phi = np.copy(restart["old_phi"])
+        for n in range(n_start,N+1):
             # Compute friction scales
             SL_nm1, SL = SL, friction_scales(u_delta, delta_sl,
                     t_delta, businger, u_o[n], delta_sl_o, SST[n],
@@ -222,16 +255,29 @@ class Atm1dStratified():
             ret_u_delta += [u_delta]
             ret_t_delta += [t_delta]
             if store_all:
-                ret_u_current += [np.copy(u_current)]
-                ret_tke += [np.copy(tke.tke_full)]
-                ret_tke_bar += [np.copy(tke.tke)]
-                ret_dz_tke += [np.copy(tke.dz_tke)]
-                ret_phi += [np.copy(phi)]
-                ret_theta += [np.copy(theta)]
-                ret_dz_theta += [np.copy(dz_theta)]
-                ret_leps += [np.copy(l_eps)]
+                ret_u_current.append(u_current)
+                ret_tke.append(tke.tke_full)
+                ret_tke_bar.append(tke.tke)
+                ret_dz_tke.append(tke.dz_tke)
+                ret_phi.append(phi)
+                ret_theta.append(theta)
+                ret_dz_theta.append(dz_theta)
+                ret_leps.append(l_eps)
                 ret_SL += [SL]
 
+            if checkpoint is not None and checkpoint.due(n):
+                checkpoint.save(n, {"n": n,
+                    "restart": {"tke": tke.tke_full, "Ku": Ku_full,
+                        "Ktheta": Ktheta_full, "l_m": l_m,
+                        "l_eps": l_eps, "old_phi": old_phi},
+                    "prognostic": (u_current, phi, theta, dz_theta),
+                    "surface": (u_delta, t_delta, SL),
+                    "lists": (all_u_star, all_t_star, ret_u_delta,
+                        ret_t_delta, ret_SL),
+                    "trajectories": (ret_u_current, ret_tke, ret_tke_bar,
+                        ret_dz_tke, ret_phi, ret_theta, ret_dz_theta,
+                        ret_leps)})
+
         ret_dict = {'u_delta' : ret_u_delta,
                 't_delta': ret_t_delta,}
 
@@ -257,6 +303,9 @@ class Atm1dStratified():
         ret_dict['l_eps'] = l_eps
         ret_dict['SL'] = SL
         ret_dict['Ktheta'] = Ktheta_full
+        ret_dict['restart'] = {"tke": tke.tke_full, "Ku": Ku_full,
+                "Ktheta": Ktheta_full, "l_m": l_m, "l_eps": l_eps,
+                "old_phi": old_phi}
         return ret_dict
 
     def FD(self, u_t0: array, theta_t0: array, Q_sw: array,
@@ -264,7 +313,8 @@ class Atm1dStratified():
             forcing_theta: array, SST:array,
             delta_sl_o: float,
             turbulence: str="TKE", sf_scheme: str="FD pure",
-            Neutral_case: bool=False, store_all: bool=False):
+            Neutral_case: bool=False, store_all: bool=False,
+            restart: dict=None, checkpoint: Checkpointer=None):
         """
             Integrates in time with Backward Euler the model with KPP
             and Finite differences.
@@ -280,6 +330,12 @@ class Atm1dStratified():
                 "FD2"     (delta_sl = z_1)
             If Neutral_case is True, no temperature profile
             is computed and t_star = 0
+            restart: ret_dict['restart'] of a previous integration
+                (turbulent state at its last time step) to continue
+                it: u_t0, theta_t0,... should then be its last state.
+            checkpoint: saves the state every checkpoint.interval
+                time steps; if it holds a checkpoint, the
+                integration resumes from it.
         """
         assert u_t0.shape[0] == self.M
         assert forcing.shape[1] == self.M
@@ -318,9 +374,25 @@ class Atm1dStratified():
         u_current: array = np.copy(u_t0)
         old_u: array = np.copy(u_current)
         all_u_star, all_t_star = [], []
-        all_u, all_tke, all_theta, all_leps = [], [], [], []
+        all_u, all_tke, all_theta, all_leps = Trajectory(), \
+                Trajectory(), Trajectory(), Trajectory()
         ret_u_delta, ret_t_delta = [], []
-        for n in range(1,N+1):
+        n_start: int = 1
+        saved = checkpoint.load() if checkpoint is not None else None
+        if saved is not None: # resumes an interrupted integration
+            n_start, restart = saved["n"] + 1, saved["restart"]
+            u_current, theta = saved["prognostic"]
+            SL = saved["SL"]
+            all_u_star, all_t_star, ret_u_delta, ret_t_delta = \
+                    saved["lists"]
+            all_u, all_tke, all_theta, all_leps = saved["trajectories"]
+        if restart is not None: # continues a previous integration
+            tke.tke_full = np.copy(restart["tke"])
+            Ku_full = np.copy(restart["Ku"])
+            Ktheta_full = np.copy(restart["Ktheta"])
+            l_m, l_eps = np.copy(restart["l_m"]), np.copy(restart["l_eps"])
+            old_u = np.copy(restart["old_u"])
+        for n in range(n_start,N+1):
             forcing_current: array = forcing[n]
             u_delta = func_un(prognostic=u_current, delta_sl=delta_sl)
             t_delta = func_theta(prognostic=theta)
@@ -344,9 +416,8 @@ class Atm1dStratified():
             self.__apply_sf_scheme(Y=Y, D=D, c=c, K_u=Ku_full,
                     func=self.dictsf_scheme[sf_scheme][1],
                     forcing=forcing_current, SL=SL)
-            next_u = self.__backward_euler(Y=Y, D=D, c=c,
-                    u=u_current, f=self.f)
-            u_current, old_u = next_u, u_current
+            systems = [self.__backward_euler(Y=Y, D=D, c=c,
+                    u=u_current, f=self.f, solve=False)]
 
             if not Neutral_case:
                 # integrate in time potential temperature
@@ -359,17 +430,37 @@ class Atm1dStratified():
                         forcing=forcing_theta[n],
                         universal_funcs=businger)
 
-                theta = np.real(self.__backward_euler(Y=Y_theta,
-                        D=D_theta, c=c_theta, u=theta, f=0.))
+                systems += [self.__backward_euler(Y=Y_theta,
+                        D=D_theta, c=c_theta, u=theta, f=0., solve=False,
+                        field="theta")]
+
+            # momentum and temperature are solved at once:
+            next_u, *next_theta = solve_systems(systems,
+                    backend=self.backend)
+            u_current, old_u = next_u, u_current
+            if not Neutral_case:
+                theta = np.real(next_theta[0])
 
             ret_u_delta += [u_delta]
             ret_t_delta += [t_delta]
 
             if store_all:
-                all_u += [np.copy(u_current)]
-                all_tke += [np.copy(tke.tke_full)]
-                all_theta += [np.copy(theta)]
-                all_leps += [np.copy(l_eps)]
+                all_u.append(u_current)
+                all_tke.append(tke.tke_full)
+                all_theta.append(theta)
+                all_leps.append(l_eps)
+
+            if checkpoint is not None and checkpoint.due(n):
+                checkpoint.save(n, {"n": n,
+                    "restart": {"tke": tke.tke_full, "Ku": Ku_full,
+                        "Ktheta": Ktheta_full, "l_m": l_m,
+                        "l_eps": l_eps, "old_u": old_u},
+                    "prognostic": (u_current, theta),
+                    "SL": SL,
+                    "lists": (all_u_star, all_t_star, ret_u_delta,
+                        ret_t_delta),
+                    "trajectories": (all_u, all_tke, all_theta,
+                        all_leps)})
 
         ret_u_delta += [func_un(prognostic=u_current,
                                 delta_sl=delta_sl)]
@@ -392,6 +483,9 @@ class Atm1dStratified():
         ret_dict['l_eps'] = l_eps
         ret_dict['SL'] = SL
         ret_dict['Ktheta'] = Ktheta_full
+        ret_dict['restart'] = {"tke": tke.tke_full, "Ku": Ku_full,
+                "Ktheta": Ktheta_full, "l_m": l_m, "l_eps": l_eps,
+                "old_u": old_u}
         return ret_dict
 
     def __step_u(self, u: array, phi: array,
@@ -459,7 +553,7 @@ class Atm1dStratified():
                 universal_funcs=businger, SL=SL, SL_nm1=SL_nm1)
         prognostic_theta[:] = np.real(self.__backward_euler(Y=Y_theta,
                 D=D_theta, c=c_theta, u=prognostic_theta, f=0.,
-                Y_nm1=Y_nm1))
+                Y_nm1=Y_nm1, field="theta"))
 
         next_theta = theta + self.dt * \
                 np.diff(prognostic_theta[1:] * Ktheta_full) \
@@ -686,7 +780,8 @@ class Atm1dStratified():
 
     def __backward_euler(self, Y: Tuple[array, array, array],
                         D: Tuple[array, array, array], c: array,
-                        u: array, f:float=0., Y_nm1=None):
+                        u: array, f:float=0., Y_nm1=None,
+                        solve: bool=True, field: str="u"):
         """
             if it's for $u$, set f=self.f otherwise f=0
             integrates once (self.dt) in time the equation
@@ -695,15 +790,31 @@ class Atm1dStratified():
             Y(1+dt*if*gamma) - D) u_np1 = Y u + dt*c + dt*if*(1-gamma)
             with gamma the coefficient of implicitation of Coriolis.
             If partial_t Y is not zero, then Y_nm1 != Y can be given.
+            If solve is False, the system (BandedMatrix, rhs) is
+            returned instead of its solution (see solve_systems).
+            The system is solved with self.backend.
+            field ("u" or "theta") selects the buffer of the matrix:
+            both systems can be assembled before being solved.
         """
         if Y_nm1 is None:
             Y_nm1=Y
-        to_inverse: Tuple[array, array, array] = add(s_mult(Y,
-                                1 + self.implicit_coriolis * \
-                            self.dt * 1j*f), s_mult(D, - self.dt))
-        return solve_linear(to_inverse,
+        # with the real backend, the systems without Coriolis are real:
+        dtype = np.result_type(*Y, *D, np.float64) if f == 0 and \
+                self.backend == "real blocks" else np.complex128
+        # the matrix is built in the buffer of the previous step:
+        self.__to_inverse[field] = BandedMatrix.from_diagonals(Y,
+                shape_bands=tuple(map(max, bands(Y), bands(D))),
+                dtype=dtype, out=self.__to_inverse.get(field))
+        to_inverse: BandedMatrix = self.__to_inverse[field]
+        if f != 0:
+            to_inverse.scale(1 + self.implicit_coriolis * self.dt * 1j*f)
+        to_inverse.add(D, -self.dt)
+        rhs: array = multiply(Y_nm1, u) + self.dt*c if f == 0 else \
                 (1 - (1 - self.implicit_coriolis) * self.dt*1j*f) * \
-                                multiply(Y_nm1, u) + self.dt*c)
+                                multiply(Y_nm1, u) + self.dt*c
+        if not solve:
+            return to_inverse, rhs
+        return to_inverse.solve(rhs, overwrite=True, backend=self.backend)
 
     def __visc_turb_FD(self, SL: SurfaceLayerData,
             turbulence: str="TKE", u_current: array=None,
@@ -1041,11 +1152,19 @@ class Atm1dStratified():
 
     def initialization(self, u_0, phi_0, t_0, dz_theta,
             delta_sl, u_o, t_o, Q_sw, Q_lw, z_constant,
-            delta_sl_o=0., u_G=8.):
+            delta_sl_o=0., u_G=8., warm_start: tuple=None,
+            tolerance: float=None, max_iter: int=15):
         """
             initialize for FV free scheme. If this is not used,
             the continuity of the reconstruction cannot be
             guaranteed.
+            The surface layer is found with a fixed point
+            of at most max_iter passes. It stops earlier when the
+            relative changes of u_delta and t_delta are
+            below tolerance.
+            warm_start is the result of a previous initialization
+            with close parameters (e.g. of the previous Schwarz
+            iterate), used as the starting point of the fixed point.
         """
         z_levels = self.z_full
         u_kp1 = u_const = u_G
@@ -1056,10 +1175,22 @@ class Atm1dStratified():
         z_constant = max(zkp1, z_constant)
         h_tilde = z_levels[k+1] - delta_sl
         phi_m, phi_h, *_ = businger
-        SL = friction_scales(u_const, delta_sl,
-                t_const, businger, u_o, delta_sl_o, t_o,
+        # For LES simulation, putting a quadratic profile between
+        # the log law and the constant profile :
+        def func_z(z):
+            return 1-((z_constant - z) / (z_constant - delta_sl))**2
+
+        u_delta, t_delta = u_const, t_const
+        if warm_start is not None:
+            _, phi_w, _, dz_theta_w, u_delta, t_delta = warm_start
+            phi_0[k+1:], dz_theta[k+1:] = phi_w[k+1:], dz_theta_w[k+1:]
+            u_kp1 = u_delta + (u_const - u_delta) * func_z(zkp1)
+            t_kp1 = t_delta + (t_const - t_delta) * func_z(zkp1)
+        SL = friction_scales(u_delta, delta_sl,
+                t_delta, businger, u_o, delta_sl_o, t_o,
                 large_ocean, None, Q_sw, Q_lw, k)
-        for _ in range(15):
+        for _ in range(max_iter):
+            previous = (u_delta, t_delta)
             zeta = delta_sl * SL.inv_L_MO
             phi_0[k] = SL.u_star / self.kappa / \
                     (SL.z_0M+SL.delta_sl) * phi_m(zeta)
@@ -1077,10 +1208,6 @@ class Atm1dStratified():
             SL = friction_scales(u_delta, delta_sl,
                 t_delta, businger, u_o, delta_sl_o, t_o,
                 large_ocean, None, SL.Q_sw, SL.Q_lw, k)
-            # For LES simulation, putting a quadratic profile between
-            # the log law and the constant profile :
-            def func_z(z):
-                return 1-((z_constant - z) / (z_constant - delta_sl))**2
 
             u_kp1 = u_delta + (u_const - u_delta) * func_z(zkp1)
             t_kp1 = t_delta + (t_const - t_delta) * func_z(zkp1)
@@ -1112,6 +1239,12 @@ class Atm1dStratified():
             dz_theta[k:] = compute_dz(dz_theta[k],
                     np.concatenate(([t_tilde], t_0[k+1:])),
                     np.concatenate(([h_tilde], self.h_half[k+1:-1])))
+            # the fluxes depend on t_delta - t_o, not on t_delta:
+            if tolerance is not None and \
+                    abs(u_delta - previous[0]) <= tolerance*abs(u_delta) \
+                    and abs(t_delta - previous[1]) <= \
+                    tolerance*abs(t_delta - t_o):
+                break
 
         tau_u, tau_t = self.__tau_sl(SL, businger)
         alpha_u = h_tilde / self.h_half[k] + tau_u
@@ -0,0 +1,145 @@
+"""
+    This module defines the class Checkpointer, used to save
+    periodically the state of long integrations and to resume
+    them after an interruption.
+    The checkpoints are written by a background thread with
+    memoisation.save_payload: the integration is not blocked
+    and a checkpoint is either complete or absent.
+"""
+import os
+import shutil
+import queue
+import threading
+import numpy as np
+import memoisation
+from trajectory import Trajectory
+
+class Checkpointer():
+    """
+        Checkpoints of an integration, stored in folder:
+        folder/<step> contains the state saved at the time step
+        <step>; only the last one is kept.
+        interval is the number of time steps between checkpoints.
+        child(name) gives the checkpoints of a sub-integration.
+    """
+    def __init__(self, folder: str, interval: int=1000):
+        self.folder: str = folder
+        self.interval: int = interval
+        self.__writer = [None] # shared with the children
+
+    def child(self, name: str) -> "Checkpointer":
+        """ checkpoints stored in folder/name (same writer) """
+        ret = Checkpointer(os.path.join(self.folder, name),
+                self.interval)
+        ret.__writer = self.__writer
+        return ret
+
+    def due(self, step: int) -> bool:
+        """ True if a checkpoint should be saved at step """
+        return step % self.interval == 0
+
+    def save(self, step: int, state) -> None:
+        """
+            saves a copy of state (arrays, lists, dicts,
+            Trajectory and immutable objects) in the background.
+        """
+        self.__get_writer().put(self.__write, step, snapshot(state))
+
+    def load(self):
+        """ returns the last state saved or None """
+        self.flush()
+        steps = self.__steps()
+        if not steps:
+            return None
+        return memoisation.load_payload(os.path.join(self.folder,
+            "%012d" % steps[-1]))
+
+    def clear(self) -> None:
+        """ deletes the checkpoints (after the pending writes) """
+        self.__get_writer().put(shutil.rmtree, self.folder, True)
+
+    def flush(self) -> None:
+        """ waits until all the checkpoints are written """
+        if self.__writer[0] is not None and self.__writer[0].alive():
+            self.__writer[0].join()
+
+    def __write(self, step: int, state) -> None:
+        os.makedirs(self.folder, exist_ok=True)
+        memoisation.save_payload(os.path.join(self.folder,
+            "%012d" % step), state)
+        for old_step in self.__steps():
+            if old_step < step:
+                shutil.rmtree(os.path.join(self.folder,
+                    "%012d" % old_step), ignore_errors=True)
+
+    def __steps(self) -> list:
+        """ sorted steps of the checkpoints written in folder """
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(int(name) for name in os.listdir(self.folder)
+                if name.isdigit())
+
+    def __get_writer(self) -> "_Writer":
+        if self.__writer[0] is None or not self.__writer[0].alive():
+            self.__writer[0] = _Writer()
+        return self.__writer[0]
+
+    def __getstate__(self) -> dict:
+        # the writer thread stays in this process
+        return {"folder": self.folder, "interval": self.interval}
+
+    def __setstate__(self, state: dict) -> None:
+        self.folder = state["folder"]
+        self.interval = state["interval"]
+        self.__writer = [None]
+
+
+class _Writer():
+    """ daemon thread executing the writes in order """
+    def __init__(self):
+        self.tasks = queue.Queue()
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def put(self, function, *args) -> None:
+        self.tasks.put((function, args))
+
+    def join(self) -> None:
+        self.tasks.join()
+
+    def alive(self) -> bool:
+        """ False in a forked process (the thread is not there) """
+        return self.pid == os.getpid() and self.thread.is_alive()
+
+    def __run(self) -> None:
+        while True:
+            function, args = self.tasks.get()
+            try:
+                function(*args)
+            except OSError as error:
+                print("Could not write a checkpoint:", error)
+            finally:
+                self.tasks.task_done()
+
+
+def snapshot(state):
+    """
+        copy of state which is not modified by the integration:
+        arrays are copied, tuples and dicts are copied recursively.
+        The lists are histories to which the integrations only
+        append items: their items are not copied.
+    """
+    if isinstance(state, np.ndarray):
+        return np.copy(state)
+    if isinstance(state, Trajectory):
+        return state.copy()
+    if isinstance(state, list):
+        return list(state)
+    if isinstance(state, tuple) and hasattr(state, "_fields"):
+        return type(state)(*(snapshot(item) for item in state))
+    if isinstance(state, tuple):
+        return tuple(snapshot(item) for item in state)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    return state
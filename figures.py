@@ -25,6 +25,7 @@ from validation_oce1D import fig_comodoParamsWindInduced
 from validation_oce1D import fig_windInduced, fig_constantCooling
 from validation_oce1D import fig_animForcedOcean
 from schwarz_coupler import NumericalSetting, schwarz_coupling, projection
+from trajectory import Trajectory, window
 
 mpl.rc('text', usetex=True)
 mpl.rcParams['text.latex.preamble']=r"\usepackage{amsmath, amsfonts}"
@@ -360,7 +361,8 @@ def simulation_coupling(dt_oce, dt_atm, T, store_all: bool,
             Q_sw=Qsw)
     states_atm, states_oce = schwarz_coupling(simulator_oce,
             simulator_atm, numer_setting, store_all=store_all,
-            NUMBER_SCHWARZ_ITERATION=NUMBER_SCHWARZ_ITERATION)
+            NUMBER_SCHWARZ_ITERATION=NUMBER_SCHWARZ_ITERATION,
+            cache_iterations=True)
     if store_all and sf_scheme_a[:2] == "FV":
         print("Reconstructing solutions...")
         for state_atm in states_atm:
@@ -369,12 +371,15 @@ def simulation_coupling(dt_oce, dt_atm, T, store_all: bool,
             all_t = state_atm.other["all_theta"]
             all_dzt = state_atm.other["all_dz_theta"]
             all_SL = state_atm.other["all_SL"]
-            for frame in range(len(all_u)):
-                za, all_u[frame], all_t[frame] = \
-                        simulator_atm.reconstruct_FV(all_u[frame],
-                        all_phi[frame], all_t[frame], all_dzt[frame],
-                        all_SL[frame],
-                        ignore_loglaw=(sf_scheme_a != "FV free"))
+            rec_u, rec_t = Trajectory(), Trajectory()
+            for u, phi, t, dzt, SL in zip(all_u, all_phi, all_t,
+                    all_dzt, all_SL):
+                za, u, t = simulator_atm.reconstruct_FV(u, phi, t, dzt,
+                        SL, ignore_loglaw=(sf_scheme_a != "FV free"))
+                rec_u.append(u)
+                rec_t.append(t)
+            state_atm.other["all_u"] = rec_u
+            state_atm.other["all_theta"] = rec_t
     elif not store_all and sf_scheme_a[:2] == "FV":
         for state_atm in states_atm:
             za, state_atm.last_tstep["u"], \
@@ -397,13 +402,16 @@ def simulation_coupling(dt_oce, dt_atm, T, store_all: bool,
             all_t = state_oce.other["all_theta"]
             all_dzt = state_oce.other["all_dz_theta"]
             all_SL = state_oce.other["all_SL"]
-            for frame in range(len(all_u)):
-                zo, all_u[frame], all_t[frame] = \
-                        simulator_oce.reconstruct_FV(all_u[frame],
-                        all_phi[frame], all_t[frame], all_dzt[frame],
-                        all_SL[frame],
-                        ignore_loglaw=(sf_scheme_o not in
+            rec_u, rec_t = Trajectory(), Trajectory()
+            for u, phi, t, dzt, SL in zip(all_u, all_phi, all_t,
+                    all_dzt, all_SL):
+                zo, u, t = simulator_oce.reconstruct_FV(u, phi, t, dzt,
+                        SL, ignore_loglaw=(sf_scheme_o not in
                             {"FV free", "FV Zeng"}))
+                rec_u.append(u)
+                rec_t.append(t)
+            state_oce.other["all_u"] = rec_u
+            state_oce.other["all_theta"] = rec_t
         print("... Done.")
     elif not store_all and sf_scheme_o[:2] == "FV":
         for state_oce in states_oce[1:]:
@@ -440,9 +448,9 @@ def fig_schwarzConvergence():
     all_u_interface_pure = []
     all_u_interface_free = []
     for state_atm in states_atm_pure:
-        all_u_interface_pure += [np.array(state_atm.other["all_u"])[:, 0]]
+        all_u_interface_pure += [window(state_atm.other["all_u"], depth=0)]
     for state_atm in states_atm_free:
-        all_u_interface_free += [np.array(state_atm.other["all_u"])[:, 0]]
+        all_u_interface_free += [window(state_atm.other["all_u"], depth=0)]
     # for state_atm in states_atm:
     #     all_u_interface += [np.array(state_atm.other["all_u_star"])]
     all_du_interface_pure = np.array(all_u_interface_pure) - \
@@ -555,16 +563,8 @@ def colorplot_coupling(ax, sf_scheme_a: str, sf_scheme_o: str,
     all_to = np.array(state_oce.other["all_theta"])
     N_oce = int(T/dt_oce)
     N_plot = 120
-    ua = np.zeros((N_plot+1, all_ua.shape[1]))
-    ta = np.zeros((N_plot+1, all_ta.shape[1]))
-    uo = np.zeros((N_plot+1, all_uo.shape[1]))
-    to = np.zeros((N_plot+1, all_to.shape[1]))
-    for i in range(all_ua.shape[1]):
-        ua[:, i] = projection(all_ua[:, i], N_plot)
-        ta[:, i] = projection(all_ta[:, i], N_plot)
-    for i in range(uo.shape[1]):
-        uo[:, i] = projection(all_uo[:, i], N_plot)
-        to[:, i] = projection(all_to[:, i], N_plot)
+    ua, ta = projection(all_ua, N_plot), projection(all_ta, N_plot)
+    uo, to = projection(all_uo, N_plot), projection(all_to, N_plot)
 
     N_threshold = 0
     T_threshold = T * N_threshold / N_plot
@@ -740,24 +740,10 @@ def fig_colorplotReconstruction():
         all_tkeo = np.real(np.array(state_oce.other["all_tke"]))
         all_to = np.array(state_oce.other["all_theta"])
         N_plot = 45
-        ua = np.zeros((N_plot+1, all_u.shape[1]))
-        ta = np.zeros((N_plot+1, all_t.shape[1]))
-        tke= np.zeros((N_plot+1, all_tke.shape[1]))
-        uo = np.zeros((N_plot+1, all_uo.shape[1]))
-        to = np.zeros((N_plot+1, all_to.shape[1]))
-        tke_o= np.zeros((N_plot+1, all_tkeo.shape[1]))
-        for i in range(all_u.shape[1]):
-            ua[:, i] = projection(all_u[:, i], N_plot)
-        for i in range(all_t.shape[1]):
-            ta[:, i] = projection(all_t[:, i], N_plot)
-        for i in range(all_tke.shape[1]):
-            tke[:,i] = projection(all_tke[:, i], N_plot)
-        for i in range(all_uo.shape[1]):
-            uo[:, i] = projection(all_uo[:, i], N_plot)
-        for i in range(all_to.shape[1]):
-            to[:, i] = projection(all_to[:, i], N_plot)
-        for i in range(all_tkeo.shape[1]):
-            tke_o[:,i] = projection(all_tkeo[:, i], N_plot)
+        ua, ta, tke = projection(all_u, N_plot), \
+                projection(all_t, N_plot), projection(all_tke, N_plot)
+        uo, to, tke_o = projection(all_uo, N_plot), \
+                projection(all_to, N_plot), projection(all_tkeo, N_plot)
         ########## pcolormesh
         x = np.linspace(0., T/86400, N_plot+2) # u.shape+1
         Xu, Yu = np.meshgrid(half_to_full(za, ocean=False), x)
@@ -10,6 +10,7 @@ from ocean1DStratified import Ocean1dStratified
 from universal_functions import Businger_et_al_1971 as businger
 from utils_linalg import solve_linear, full_to_half, oversample
 from schwarz_coupler import NumericalSetting, schwarz_coupling, projection
+from trajectory import Trajectory
 
 def simulation_unstable(dt_atm, T, store_all: bool,
         sf_scheme_a: str, delta_sl_a: float=None,
@@ -62,12 +63,15 @@ def simulation_unstable(dt_atm, T, store_all: bool,
         all_t = state_atm.other["all_theta"]
         all_dzt = state_atm.other["all_dz_theta"]
         all_SL = state_atm.other["all_SL"]
-        for frame in range(len(all_u)):
-            za, all_u[frame], all_t[frame] = \
-                    simulator_atm.reconstruct_FV(all_u[frame],
-                    all_phi[frame], all_t[frame], all_dzt[frame],
-                    all_SL[frame],
-                    ignore_loglaw=(sf_scheme_a != "FV free"))
+        rec_u, rec_t = Trajectory(), Trajectory()
+        for u, phi, t, dzt, SL in zip(all_u, all_phi, all_t,
+                all_dzt, all_SL):
+            za, u, t = simulator_atm.reconstruct_FV(u, phi, t, dzt,
+                    SL, ignore_loglaw=(sf_scheme_a != "FV free"))
+            rec_u.append(u)
+            rec_t.append(t)
+        state_atm.other["all_u"] = rec_u
+        state_atm.other["all_theta"] = rec_t
     elif not store_all and sf_scheme_a[:2] == "FV":
         za, state_atm.last_tstep["u"], \
                 state_atm.last_tstep["theta"], = \
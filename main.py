@@ -11,9 +11,14 @@
     ./main.py figname fig_foo_bar
     You can generate all figures
     by using the command "./main.py all_figures".
+    "./main.py all_figures 4" does the same with 4 processes.
 
     All the results are stored in cache_npy to allow a fast re-generation
     of figures. You can clean cache with "./main.py clean".
+    "./main.py cache {stats, prune [SIZE], evict FUNCTION}" gives
+    the usage of the cache and evicts entries.
+    "./main.py benchmark" compares the solvers of the complex
+    systems (see utils_linalg.COMPLEX_BACKEND).
 """
 import figures
 
@@ -56,14 +61,21 @@ def main():
                 else:
                     print("id does not exist. Please use one of:")
                     print(list(ALL_LABELS.keys()))
+        #  example of use : ./main.py all_figures 4
+        #  (the optional argument is the number of processes)
         elif sys.argv[1] == "all_figures":
-            figures.set_save_to_pdf()
             from label_to_figure import ALL_LABELS
-            import matplotlib
-            matplotlib.use('Agg')
-            for number_fig in ALL_LABELS:
-                print("Exporting Figure", number_fig)
-                figures.all_figures[ALL_LABELS[number_fig]]()
+            if len(sys.argv) > 2:
+                from multiprocessing import Pool
+                with Pool(int(sys.argv[2])) as pool:
+                    pool.map(global_launch_figsave, ALL_LABELS)
+            else:
+                figures.set_save_to_pdf()
+                import matplotlib
+                matplotlib.use('Agg')
+                for number_fig in ALL_LABELS:
+                    print("Exporting Figure", number_fig)
+                    figures.all_figures[ALL_LABELS[number_fig]]()
 
         elif sys.argv[1] == "figsavepgf":
             # Does not work yet.
@@ -106,15 +118,59 @@ def main():
             memoisation.clean()
             print("Memoisation folder cleaned.")
 
+        # manage the cache. examples of use :
+        # ./main.py cache stats
+        # ./main.py cache prune 20G (default: $MEMOISATION_MAX_SIZE
+        #                           or memoisation.MAX_CACHE_SIZE)
+        # ./main.py cache evict simulation_coupling
+        elif sys.argv[1] == "cache":
+            import memoisation
+            if len(sys.argv) == 2 or sys.argv[2] == "stats":
+                print(f"{'function':40s} {'entries':>8s} {'MB':>10s}" +
+                        f" {'hits':>6s} {'misses':>6s} {'hit rate':>8s}")
+                for fun, entries, size, hits, misses in \
+                        memoisation.cache_stats():
+                    rate = hits / max(hits + misses, 1)
+                    print(f"{fun:40s} {entries:8d} {size/1e6:10.1f}" +
+                            f" {hits:6d} {misses:6d} {rate:8.0%}")
+                for fun, key, owner in memoisation.in_flight():
+                    print("being computed: " + fun + "/" + key +
+                            " (" + str(owner) + ")")
+            elif sys.argv[2] == "prune":
+                max_size = memoisation.parse_size(sys.argv[3]) \
+                        if len(sys.argv) > 3 else \
+                        memoisation.max_cache_size()
+                if max_size is None:
+                    sys.exit("Usage: main.py cache prune SIZE (or set " +
+                            "$MEMOISATION_MAX_SIZE)")
+                freed = memoisation.prune(max_size)
+                print(f"{freed/1e6:.1f} MB freed.")
+            elif sys.argv[2] == "evict" and len(sys.argv) > 3:
+                freed = memoisation.evict(sys.argv[3])
+                print(f"{freed/1e6:.1f} MB freed.")
+            else:
+                print("Usage: main.py cache {stats, prune [SIZE], " +
+                        "evict FUNCTION}")
+
+        # compare the backends of the complex linear systems
+        # example of use : ./main.py benchmark
+        elif sys.argv[1] == "benchmark":
+            import utils_linalg
+            times = utils_linalg.benchmark_backends()
+            for backend in utils_linalg.BACKENDS:
+                faster = sum(min(time, key=time.get) == backend
+                        for time in times.values())
+                print(f"{backend}: fastest in {faster}/{len(times)} cases")
+            print("default backend:", utils_linalg.COMPLEX_BACKEND)
+
         # Verify installation, and run non-regression tests
         # example of use : ./main.py test
         elif sys.argv[1] == "test":
             if len(sys.argv) > 2:
                 print("Unknown second argument.")
             else:
-                # from tests import launch_all_tests
-                # launch_all_tests()
-                pass
+                from tests import launch_all_tests
+                launch_all_tests()
 
             import label_to_figure
             for val in label_to_figure.ALL_LABELS.values():
@@ -140,10 +196,11 @@ def global_launch_figsave(number_fig):
         This function launch an external python context for figure number_fig.
         It allows to create a new matplotlib context, which is needed
             to create different figures.
-        it is slightly better to launch this function sequentially
-            because of the risk of concurrent access to cache.
-        By launching multiple figures in parallel you will gain time
-            but you may do some computations multiple times.
+        The cache can be shared by several processes: the results
+            and the indexes are written atomically under a lock.
+        By launching multiple figures in parallel you will gain time:
+            a result being computed by a process is not computed
+            again by the others, they wait for it.
     """
     import os
     os.system('nice ./main.py figsave ' + str(number_fig))
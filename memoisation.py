@@ -2,21 +2,80 @@
     This module is a very simple and effective module
     to perform memoisation on the heavy computations.
     The only problem is the limited possible types of arguments.
-    The only possible parameters are litterals...
+    The possible parameters are litterals (None, bool, numbers, str),
+    tuples, lists, dicts and NamedTuples of those, np.ndarray
+    (hashed by content) and functions or FunMem (identified by
+    their qualified name).
     If you want to use an other parameter,
-    just implement its __hash__ and __eq__ function.
+    just implement a __repr__ that depends only on its content.
+    The keys are stable digests of the arguments: two different
+    processes (or two different days) find the same entry.
+    Each entry also records a fingerprint of the source code of
+    the memoised function and of the code of this project it uses
+    (transitively): if it changes, the entry is computed again.
+    A computation in progress is registered: the other processes
+    which need the same result wait for it (see _in_flight).
+    The arrays of the results are stored as raw .npy files which are
+    memory-mapped when loaded (see save_payload and load_payload).
     This module is exactly "percache", except it is less efficient
     and does not uses decoratos. I prefer having something I know
     to be able to delete only small parts of the cache.
     In a futur version of the code I may use the cache.
 """
+import os
+import sys
+import glob
+import time
+import types
+import fcntl
+import inspect
+import importlib
+import sqlite3
+import hashlib
+import shutil
+import numbers
+import tempfile
+import weakref
+import atexit
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from contextlib import contextmanager
 import numpy as np
 
 # everything is stored in the following folder.
 # To know its size, "du -h <MEMOISATION_FOLDER_NAME>"
 MEMOISATION_FOLDER_NAME = "cache_npy"
 INDEX_NAME = MEMOISATION_FOLDER_NAME + "/index"
+# single index for all the memoised functions. The results
+# themselves are still stored in <MEMOISATION_FOLDER_NAME>/<fun>/
+DATABASE_NAME = INDEX_NAME + ".sqlite"
 KEY_FOR_UNIQUE_ITEM = "key"
+# disk budget (in bytes) of the cache, e.g. MEMOISATION_MAX_SIZE=20G.
+# None means no limit. When it is exceeded, the entries
+# with the lowest eviction_score are deleted.
+MAX_CACHE_SIZE = None
+# an entry which was not accessed since EVICTION_HALF_LIFE seconds
+# is worth half of what it was worth at its last access:
+EVICTION_HALF_LIFE = 7 * 86400.
+# compute duration assumed for the entries imported from old indexes:
+UNKNOWN_DURATION = 3600.
+# The arrays of the results are stored as raw .npy files and
+# memory-mapped when loaded: the data is read only when it is used.
+# "c" (copy-on-write) allows to modify the loaded arrays in memory
+# without modifying the cache.
+MMAP_MODE = "c"
+# smaller arrays are read directly (each memory map holds a file descriptor)
+MMAP_MIN_BYTES = 1 << 20
+# The arrays are stored once in this folder (named by their digest):
+# the results hold hard links to them, so that e.g. the iterations
+# cached by schwarz_coupling and the final result share their arrays.
+LEAVES_FOLDER_NAME = MEMOISATION_FOLDER_NAME + "/_leaves"
+# The last results are also kept in memory (for each process),
+# up to MEMORY_CACHE_MAX_SIZE bytes (overriden by
+# e.g. $MEMOISATION_MEMORY_SIZE=2G; 0 disables it)
+# and MEMORY_CACHE_MAX_ENTRIES results.
+MEMORY_CACHE_MAX_SIZE = 1e9
+MEMORY_CACHE_MAX_ENTRIES = 128
 
 
 def clean():
@@ -26,24 +85,16 @@ def clean():
         Don't forget to call this function if you change
         the computation (e.g. if you touch to simulator.py or a discretization) !
     """
-    import os
-    import glob
-    for filename in glob.iglob(MEMOISATION_FOLDER_NAME + "/*",
-                               recursive=True):
+    _connection["pid"] = _connection["connection"] = None
+    for filename in glob.iglob(MEMOISATION_FOLDER_NAME + "/*"):
         try:
-            os.remove(filename)
+            if os.path.isdir(filename):
+                shutil.rmtree(filename)
+            else:
+                os.remove(filename)
         except OSError:
-            for hashed_file in glob.iglob(filename + "/*",
-                                       recursive=True):
-                try:
-                    os.remove(hashed_file)
-                except OSError:
-                    print("Error : recursion of more than one folder")
-            try:
-                os.removedirs(filename)
-            except OSError:
-                print("please clean manually folder " +
-                      MEMOISATION_FOLDER_NAME)
+            print("please clean manually folder " +
+                  MEMOISATION_FOLDER_NAME)
 
 
 def memoised(func_to_memoise, *args_mem, ignore_cached=False, **kwargs_mem):
@@ -54,53 +105,1050 @@ def memoised(func_to_memoise, *args_mem, ignore_cached=False, **kwargs_mem):
         by: memoised(fun, my_arg1, my_arg2, my_kwarg1=my_val1)
         if ignore_cached is True, fun will be called even if it is in the cache.
         The cache content is replaced by the new value.
+        Repeated calls in the same process are served from memory
+        (without reading the disk): the arrays of the results are
+        then read-only views shared by all the calls.
     """
     fun = func_to_memoise
-    import os
-    filename_dict = INDEX_NAME + "_" + fun.__name__ + ".npy"
-    try:
-        dic = np.load(filename_dict, allow_pickle=True)[()]
-    except IOError:  # there is no index yet !
-        dic = {}
-
     directory = MEMOISATION_FOLDER_NAME + "/" + fun.__name__
     os.makedirs(directory, exist_ok=True)
-    key_dic = (*args_mem, tuple((key, val)
-                                for key, val in sorted(kwargs_mem.items())))
+    key, fingerprint = _key_and_fingerprint(fun, args_mem, kwargs_mem)
+    memory_key = (fun.__name__, key, fingerprint)
+    if not ignore_cached:
+        res = _memory_cache.get(memory_key)
+        if res is not None:
+            _count(fun.__name__, hit=True)
+            _access(fun.__name__, key, fingerprint)
+            return res
+    filename_cached = None if ignore_cached else \
+            _lookup(fun.__name__, key, fingerprint)
 
-    if key_dic in dic and not ignore_cached:
-        # dic[key_dic] is the name of the file we're interested in.
+    if filename_cached is not None:
         try:
-            res = np.load(dic[key_dic], allow_pickle=True)[()][KEY_FOR_UNIQUE_ITEM]
+            res = load_payload(filename_cached)
             if res is None:
                 print("That is strange, we have a None result... " +
                       "Let's compute it again.")
             else:
-                print("Found value for " + fun.__name__ + " in cache. " +
-                      "If you changed anything in the function, " +
-                      "run \"./main.py clean\"")
-                return res
+                print("Found value for " + fun.__name__ + " in cache.")
+                _count(fun.__name__, hit=True)
+                return _memory_cache.put(memory_key, res)
         except IOError:
             print("A file in the memoisation index doesn't exist.")
+    _count(fun.__name__, hit=False)
+
+    # The name of the folder only depends on the arguments:
+    filename_res = directory + "/" + key
+    with _in_flight(filename_res, fun.__name__) as waited:
+        if waited and not ignore_cached:
+            # an other process was computing the same result
+            filename_cached = _lookup(fun.__name__, key, fingerprint)
+            if filename_cached is not None:
+                res = load_payload(filename_cached)
+                print("Found value for " + fun.__name__ +
+                        " computed by an other process.")
+                return _memory_cache.put(memory_key, res)
+        # Finally, we can compute and store our result.
+        start = time.time()
+        res = fun(*args_mem, **kwargs_mem)
+        duration = time.time() - start
+        with _locked(filename_res, remove=True):
+            save_payload(filename_res, res)
+        _insert(fun.__name__, key, filename_res, fingerprint, duration)
+    res = _memory_cache.put(memory_key, res)
+    if max_cache_size() is not None:
+        prune(max_cache_size(), keep=(fun.__name__, key))
+    return res
+
+
+def lookup(fun, *args_mem, **kwargs_mem):
+    """
+        returns the value of fun(*args_mem, **kwargs_mem) stored in
+        the disk cache (by memoised or store), or None if there is none.
+        fun is not called. Contrary to memoised, the in-memory
+        cache is not used: each call returns a new object.
+    """
+    key, fingerprint = _key_and_fingerprint(fun, args_mem, kwargs_mem)
+    filename_cached = _lookup(fun.__name__, key, fingerprint)
+    if filename_cached is None:
+        return None
+    try:
+        return load_payload(filename_cached)
+    except IOError:
+        return None
+
+
+def store(res, fun, *args_mem, compute_duration: float=None,
+        **kwargs_mem) -> None:
+    """
+        stores res in the disk cache as the value of
+        fun(*args_mem, **kwargs_mem). fun is not called.
+        compute_duration (in seconds) is used to choose
+        which entries are evicted first.
+    """
+    directory = MEMOISATION_FOLDER_NAME + "/" + fun.__name__
+    os.makedirs(directory, exist_ok=True)
+    key, fingerprint = _key_and_fingerprint(fun, args_mem, kwargs_mem)
+    filename_res = directory + "/" + key
+    with _locked(filename_res, remove=True):
+        save_payload(filename_res, res)
+    _insert(fun.__name__, key, filename_res, fingerprint, compute_duration)
+    if max_cache_size() is not None:
+        prune(max_cache_size(), keep=(fun.__name__, key))
+
+
+def _key_and_fingerprint(fun, args_mem: tuple, kwargs_mem: dict):
+    """
+        returns the stable key of the arguments and the
+        fingerprint of the code used by fun(*args_mem, **kwargs_mem)
+    """
+    key_dic = (*args_mem, tuple((key, val)
+                                for key, val in sorted(kwargs_mem.items())))
+    return stable_key(key_dic), \
+            source_fingerprint(fun, *args_mem, *kwargs_mem.values())
+
+
+class _MemoryCache():
+    """
+        LRU cache in front of the disk: maps (fun, key, fingerprint)
+        to the result. Its size is the estimated number of bytes
+        of the results (see _nbytes); the least recently used
+        results are dropped when it exceeds MEMORY_CACHE_MAX_SIZE
+        or when it holds more than MEMORY_CACHE_MAX_ENTRIES results.
+        The arrays of the results are made read-only and each call
+        receives its own copy of the containers (see _read_only).
+        stats[fun] = [hits, misses] in this process.
+    """
+    def __init__(self):
+        self.results = OrderedDict()
+        self.size = 0
+        self.stats = {}
+
+    def get(self, memory_key):
+        """ returns the result or None if it is not in memory """
+        if _memory_cache_max_size() <= 0: # disabled
+            return None
+        counter = self.stats.setdefault(memory_key[0], [0, 0])
+        if memory_key not in self.results:
+            counter[1] += 1
+            return None
+        counter[0] += 1
+        self.results.move_to_end(memory_key)
+        return _read_only(self.results[memory_key][0])
+
+    def put(self, memory_key, res):
+        """
+            inserts res and drops the oldest results if needed.
+            returns the object to give to the caller instead of res.
+        """
+        max_size = _memory_cache_max_size()
+        if memory_key in self.results:
+            self.size -= self.results.pop(memory_key)[1]
+        size = _nbytes(res)
+        if size > max_size:
+            return res
+        res = _read_only(res)
+        self.results[memory_key] = (res, size)
+        self.size += size
+        while self.size > max_size or \
+                len(self.results) > MEMORY_CACHE_MAX_ENTRIES:
+            _, (_, old_size) = self.results.popitem(last=False)
+            self.size -= old_size
+        return _read_only(res)
+
+
+_memory_cache = _MemoryCache()
+
+
+def memory_stats() -> dict:
+    """
+        returns {fun: (hits, misses)} of the in-memory cache
+        for the current process.
+    """
+    return {fun: tuple(counter)
+            for fun, counter in _memory_cache.stats.items()}
+
+
+def _memory_cache_max_size() -> float:
+    """ MEMORY_CACHE_MAX_SIZE, overriden by $MEMOISATION_MEMORY_SIZE """
+    if "MEMOISATION_MEMORY_SIZE" in os.environ:
+        return parse_size(os.environ["MEMOISATION_MEMORY_SIZE"])
+    return MEMORY_CACHE_MAX_SIZE
+
+
+def _nbytes(obj) -> int:
+    """ estimation of the number of bytes used by obj """
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sys.getsizeof(obj) + sum(_nbytes(item) for item in obj)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(_nbytes(key) + _nbytes(item)
+                for key, item in obj.items())
+    if getattr(type(obj), "MEMOISATION_SPLIT", False):
+        return _nbytes(vars(obj))
+    return sys.getsizeof(obj, 64)
+
+
+def _read_only(obj):
+    """
+        copy of the containers (tuples, lists, dicts,...) of obj
+        where the arrays are replaced by read-only views: modifying
+        the arrays of the copy raises, modifying its containers
+        does not modify obj.
+    """
+    if isinstance(obj, np.ndarray):
+        if not obj.flags.writeable:
+            return obj
+        view = obj.view()
+        view.flags.writeable = False
+        return view
+    if isinstance(obj, tuple) and hasattr(obj, "_fields"): # NamedTuple
+        return type(obj)(*(_read_only(item) for item in obj))
+    if isinstance(obj, (tuple, list)):
+        return type(obj)([_read_only(item) for item in obj])
+    if type(obj) is dict:
+        return {key: _read_only(val) for key, val in obj.items()}
+    if getattr(type(obj), "MEMOISATION_SPLIT", False):
+        copy = type(obj).__new__(type(obj))
+        copy.__setstate__(_read_only(obj.__getstate__()))
+        return copy
+    return obj
+
+
+def cache_stats() -> list:
+    """
+        returns a list of tuples (fun, number of entries,
+        bytes used, hits, misses) for each memoised function.
+        Hits and misses are counted since the creation of the cache.
+    """
+    _flush_pending()
+    with _database() as database:
+        return database.execute("SELECT fun, COUNT(key), " +
+                "COALESCE(SUM(size), 0), COALESCE(MAX(hits), 0), " +
+                "COALESCE(MAX(misses), 0) FROM (" +
+                "SELECT fun, key, size, NULL AS hits, NULL AS misses " +
+                "FROM entries UNION ALL " +
+                "SELECT fun, NULL, NULL, hits, misses FROM stats) " +
+                "GROUP BY fun ORDER BY fun").fetchall()
+
+
+def eviction_score(size: int, duration: float, age: float) -> float:
+    """
+        value of an entry: seconds of computation saved per byte,
+        discounted by the time since the last access (age, in seconds).
+        The entries of lowest score are evicted first: cheap
+        or forgotten entries go first.
+    """
+    if duration is None:
+        duration = UNKNOWN_DURATION
+    return duration / max(size, 1) / (1. + age / EVICTION_HALF_LIFE)
+
+
+def prune(max_size: float=None, keep: tuple=None) -> int:
+    """
+        Evicts entries until the cache uses less than max_size bytes
+        (by default max_cache_size()). keep=(fun, key) is never evicted.
+        The arrays which are not used anymore are deleted.
+        returns the number of bytes freed.
+    """
+    if max_size is None:
+        max_size = max_cache_size()
+    if max_size is None:
+        return 0
+    _flush_pending() # last accesses
+    now = time.time()
+    with _database() as database:
+        rows = database.execute("SELECT fun, key, filename, size, " +
+                "duration, last_access FROM entries").fetchall()
+    total = sum(row[3] for row in rows)
+    if total > max_size:
+        # the arrays shared by several entries (see _payload_size)
+        # may have been shared by others since they were recorded:
+        rows = [row[:3] + (_payload_size(row[2]) if
+            os.path.exists(row[2]) else 0,) + row[4:] for row in rows]
+        with _database() as database:
+            database.executemany("UPDATE entries SET size=? " +
+                    "WHERE fun=? AND key=?",
+                    [(row[3], row[0], row[1]) for row in rows])
+        total = sum(row[3] for row in rows)
+    rows.sort(key=lambda row: eviction_score(row[3], row[4],
+        now - row[5]))
+    freed = 0
+    for fun_name, key, filename, size, *_ in rows:
+        if total - freed <= max_size:
+            break
+        if (fun_name, key) != keep:
+            _remove_entry(fun_name, key, filename)
+            freed += size
+    _collect_leaves()
+    return freed
+
+
+def evict(fun_name: str) -> int:
+    """
+        Removes all the cached values of the function fun_name.
+        returns the number of bytes freed.
+    """
+    with _database() as database:
+        rows = database.execute("SELECT key, filename, size FROM " +
+                "entries WHERE fun=?", (fun_name,)).fetchall()
+    for key, filename, _ in rows:
+        _remove_entry(fun_name, key, filename)
+    _collect_leaves()
+    return sum(row[2] for row in rows)
+
+
+def _remove_entry(fun_name: str, key: str, filename: str) -> None:
+    """ deletes the result file, its lock file and the index entry """
+    with _locked(filename, remove=True):
+        with _database() as database:
+            database.execute("DELETE FROM entries WHERE fun=? AND key=?",
+                    (fun_name, key))
+        if os.path.isdir(filename):
+            shutil.rmtree(filename)
+        elif os.path.isfile(filename):
+            os.remove(filename)
+
+
+def max_cache_size():
+    """
+        disk budget of the cache: MAX_CACHE_SIZE, overriden
+        by $MEMOISATION_MAX_SIZE (None if there is no limit)
+    """
+    if "MEMOISATION_MAX_SIZE" in os.environ:
+        return parse_size(os.environ["MEMOISATION_MAX_SIZE"])
+    return MAX_CACHE_SIZE
+
+
+def parse_size(size: str) -> float:
+    """ "500M" -> 500e6; accepts the suffixes K, M, G, T """
+    size = size.strip().upper().rstrip("B")
+    factors = {"K": 1e3, "M": 1e6, "G": 1e9, "T": 1e12}
+    if size and size[-1] in factors:
+        return float(size[:-1]) * factors[size[-1]]
+    return float(size)
+
+
+# hits, misses and last accesses not written in the index yet:
+# they are written by batches of PENDING_MAX (see _flush_pending).
+PENDING_MAX = 100
+_pending = {"pid": None, "counts": {}, "accesses": {}, "events": 0}
+
+
+def _pending_of_process() -> dict:
+    """ _pending, emptied in a forked process (they are the parent's) """
+    if _pending["pid"] != os.getpid():
+        _pending.update(pid=os.getpid(), counts={}, accesses={}, events=0)
+    return _pending
+
+
+def _count(fun_name: str, hit: bool) -> None:
+    """ increments the number of hits (or misses) of fun_name """
+    pending = _pending_of_process()
+    pending["counts"].setdefault(fun_name, [0, 0])[0 if hit else 1] += 1
+    pending["events"] += 1
+    if pending["events"] >= PENDING_MAX:
+        _flush_pending()
+
+
+def _access(fun_name: str, key: str, fingerprint: str) -> None:
+    """ updates (later) the last access of an entry """
+    _pending_of_process()["accesses"][(fun_name, key)] = \
+            (time.time(), fingerprint)
+
+
+@atexit.register
+def _flush_pending() -> None:
+    """ writes the pending hits, misses and accesses in the index """
+    pending = _pending_of_process()
+    if not pending["counts"] and not pending["accesses"]:
+        return
+    with _database() as database:
+        for fun_name, (hits, misses) in pending["counts"].items():
+            database.execute("INSERT OR IGNORE INTO stats (fun, hits, " +
+                    "misses) VALUES (?, 0, 0)", (fun_name,))
+            database.execute("UPDATE stats SET hits=hits+?, " +
+                    "misses=misses+? WHERE fun=?", (hits, misses, fun_name))
+        # entries which predate the fingerprints are adopted:
+        database.executemany("UPDATE entries SET " +
+                "last_access=MAX(COALESCE(last_access, 0), ?), " +
+                "fingerprint=COALESCE(fingerprint, ?) " +
+                "WHERE fun=? AND key=?", [(now, fingerprint, fun_name, key)
+                    for (fun_name, key), (now, fingerprint)
+                    in pending["accesses"].items()])
+    pending.update(counts={}, accesses={}, events=0)
+
+
+def _lookup(fun_name: str, key: str, fingerprint: str):
+    """
+        returns the filename of the result of fun_name
+        for the given key (None if there is no entry or if
+        the entry was computed with an other source code).
+        The last access of the entry is updated (see _access).
+        Entries which predate the fingerprints are adopted.
+    """
+    row = _database().execute("SELECT filename, fingerprint " +
+            "FROM entries WHERE fun=? AND key=?",
+            (fun_name, key)).fetchone()
+    if row is None:
+        return None
+    if row[1] is not None and row[1] != fingerprint:
+        print("The code used by " + fun_name + " changed " +
+                "since the cached value was computed.")
+        return None
+    _access(fun_name, key, fingerprint)
+    return row[0]
+
+
+def _insert(fun_name: str, key: str, filename: str,
+        fingerprint: str, duration: float=None) -> None:
+    """
+        inserts (or replaces) an entry of the index.
+        duration is the time (in seconds) taken by the computation,
+        None if it is unknown.
+    """
+    _flush_pending()
+    now = time.time()
+    with _database() as database:
+        database.execute("INSERT OR REPLACE INTO entries " +
+                "(fun, key, filename, size, created, duration, " +
+                "last_access, fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (fun_name, key, filename, _payload_size(filename),
+                    now, duration, now, fingerprint))
+
+
+# directory of the code of the project: only the sources
+# inside this directory are taken into account by the fingerprints
+PROJECT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+# modules and globals which cannot change the results: the cache
+# itself, the checkpoints and the debugging checks.
+# They are not part of the fingerprints.
+FINGERPRINT_IGNORED = {"memoisation", "checkpoint",
+        "utils_linalg.CHECK_FINITE"}
+# fingerprints are computed once per process:
+_fingerprints = {}
+
+
+def source_fingerprint(*objects) -> str:
+    """
+        returns a digest of the source code of the functions
+        (or FunMem, classes, modules) inside objects and of all the
+        code of the project they use, transitively.
+        Other objects (e.g. the arguments of memoised) are ignored.
+        Editing bulk.friction_scales changes the fingerprint of
+        every function calling it (even indirectly) but not
+        the fingerprint of the other functions.
+    """
+    codes = [_unwrap(obj) for obj in objects]
+    codes = [code for code in codes if _in_project(code)]
+    names = tuple(_qualified_name(code) for code in codes)
+    if names not in _fingerprints:
+        dependencies = {}
+        for code in codes:
+            _collect_dependencies(code, dependencies)
+        digest = hashlib.sha256()
+        for name in sorted(dependencies):
+            digest.update(_canonical(name))
+            digest.update(_canonical(dependencies[name]))
+        _fingerprints[names] = digest.hexdigest()
+    return _fingerprints[names]
+
+
+def _unwrap(obj):
+    """ returns the python object behind FunMem or numba functions """
+    if isinstance(obj, FunMem):
+        return _unwrap(obj.fun)
+    return getattr(obj, "py_func", obj)
+
+
+def _in_project(obj) -> bool:
+    """ True if obj is a function, class or module of the project """
+    if not isinstance(obj, (types.FunctionType, type, types.ModuleType)):
+        return False
+    module = obj if isinstance(obj, types.ModuleType) else \
+            sys.modules.get(obj.__module__)
+    filename = getattr(module, "__file__", None)
+    return filename is not None and \
+            os.path.dirname(os.path.abspath(filename)) == PROJECT_FOLDER
+
+
+def _collect_dependencies(obj, dependencies: dict) -> None:
+    """
+        adds to dependencies {qualified name: source} the source
+        of obj (function, class or module of the project)
+        and of the project objects it refers to.
+        The constants referred to are added with their value.
+        The modules of FINGERPRINT_IGNORED are not visited.
+    """
+    if isinstance(obj, types.ModuleType):
+        name = module = obj.__name__
+    else:
+        name, module = _qualified_name(obj), obj.__module__
+    if name in dependencies or module in FINGERPRINT_IGNORED:
+        return
+    try:
+        dependencies[name] = inspect.getsource(obj)
+    except (OSError, TypeError, SyntaxError, ValueError):
+        # source is not available (or its file cannot be parsed)
+        dependencies[name] = _bytecode(obj)
+
+    if isinstance(obj, types.ModuleType):
+        referred = list(vars(obj).values())
+    elif isinstance(obj, type):
+        referred = []
+        for attribute in vars(obj).values():
+            attribute = getattr(attribute, "__func__", attribute)
+            if isinstance(attribute, property):
+                attribute = attribute.fget
+            if isinstance(attribute, types.FunctionType) and \
+                    _in_project(attribute):
+                referred += _referred_globals(attribute, dependencies)
+    else:
+        referred = _referred_globals(obj, dependencies)
+
+    while referred:
+        value = _unwrap(referred.pop())
+        if isinstance(value, (tuple, list)): # e.g. universal functions
+            referred += list(value)
+        elif _in_project(value):
+            _collect_dependencies(value, dependencies)
+
+
+def _bytecode(obj) -> str:
+    """ bytecode of a function or of the methods of a class """
+    if isinstance(obj, type):
+        return "".join(_bytecode(getattr(attribute, "__func__", attribute))
+                for _, attribute in sorted(vars(obj).items()))
+    code = getattr(obj, "__code__", None)
+    return "" if code is None else code.co_code.hex()
+
+
+def _referred_globals(function, dependencies: dict) -> list:
+    """
+        returns the objects referred to by name in the code
+        of function (including nested functions).
+        Data constants (immutable literals) are added
+        to dependencies.
+    """
+    names = set()
+    codes = [function.__code__]
+    while codes:
+        code = codes.pop()
+        names.update(code.co_names)
+        codes += [const for const in code.co_consts
+                if isinstance(const, types.CodeType)]
+    referred = []
+    for name in sorted(names):
+        if name in function.__globals__:
+            value = function.__globals__[name]
+        elif os.path.isfile(os.path.join(PROJECT_FOLDER, name + ".py")):
+            # local "import module", maybe not imported yet
+            value = importlib.import_module(name)
+        else: # attribute or builtin
+            continue
+        if isinstance(value, types.ModuleType):
+            if not _in_project(value):
+                continue
+            # only the attributes used (module.attribute) are kept:
+            referred += [getattr(value, attribute) for attribute
+                    in sorted(names) if hasattr(value, attribute)]
+        elif isinstance(value, (types.FunctionType, type, FunMem)) \
+                or hasattr(value, "py_func"):
+            referred.append(value)
+        else:
+            if isinstance(value, (tuple, list)):
+                referred.append(value)
+            # mutable objects (caches, connections...) and private
+            # globals (e.g. _pool_simulators, None or not) are runtime
+            # state: they would change the fingerprint during a run
+            qualified_name = function.__module__ + "." + name
+            if _is_literal(value) and not name.startswith("_") and \
+                    qualified_name not in FINGERPRINT_IGNORED:
+                dependencies[qualified_name] = \
+                        _canonical(value).decode("utf-8", "replace")
+    return referred
+
+
+def _is_literal(value) -> bool:
+    """ True for None, numbers, str, bytes and tuples of those """
+    if isinstance(value, tuple):
+        return all(_is_literal(item) for item in value)
+    return value is None or isinstance(value, (numbers.Number, str, bytes))
 
-    filename_res = directory + "/" + repr(hash(key_dic)) + ".npy"
-    # Store the filename in the dictionnary...
-    while filename_res in dic.values():
-        print("warning: collision in hashes or bug; very rare event")
-        filename_res += str(int(np.random.rand()*1000))
 
+# connection to DATABASE_NAME, opened once per process:
+_connection = {"pid": None, "connection": None}
+
+
+def _database() -> sqlite3.Connection:
+    """
+        returns the connection to the index, which can be used as
+        a context manager to commit a transaction.
+        The first time, the database is created and the old
+        indexes <INDEX_NAME>_<fun>.npy are imported.
+    """
+    if _connection["pid"] != os.getpid(): # no connection or forked
+        os.makedirs(MEMOISATION_FOLDER_NAME, exist_ok=True)
+        with _locked(DATABASE_NAME):
+            connection = sqlite3.connect(DATABASE_NAME, timeout=600.)
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS entries (" +
+                        "fun TEXT NOT NULL, key TEXT NOT NULL, " +
+                        "filename TEXT NOT NULL, size INTEGER, " +
+                        "created REAL, duration REAL, last_access REAL, " +
+                        "fingerprint TEXT, PRIMARY KEY (fun, key))")
+                columns = [column[1] for column in
+                        connection.execute("PRAGMA table_info(entries)")]
+                if "fingerprint" not in columns:
+                    connection.execute("ALTER TABLE entries " +
+                            "ADD COLUMN fingerprint TEXT")
+                connection.execute("CREATE TABLE IF NOT EXISTS stats (" +
+                        "fun TEXT PRIMARY KEY, hits INTEGER, " +
+                        "misses INTEGER)")
+                _import_npy_indexes(connection)
+        _connection["pid"] = os.getpid()
+        _connection["connection"] = connection
+    return _connection["connection"]
+
+
+def _import_npy_indexes(connection: sqlite3.Connection) -> None:
+    """
+        Imports in the database the indexes written by the
+        old versions of this module (one pickled dictionnary
+        per memoised function). They are deleted afterward.
+    """
+    for filename_dict in glob.glob(INDEX_NAME + "_*.npy"):
+        fun_name = filename_dict[len(INDEX_NAME + "_"):-len(".npy")]
+        directory = MEMOISATION_FOLDER_NAME + "/" + fun_name
+        for key, filename in _load_npy_index(filename_dict,
+                directory).items():
+            if os.path.isfile(filename):
+                created = os.path.getmtime(filename)
+                connection.execute("INSERT OR IGNORE INTO entries " +
+                        "(fun, key, filename, size, created, " +
+                        "last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                        (fun_name, key, filename,
+                            os.path.getsize(filename), created, created))
+        os.remove(filename_dict)
+        if os.path.isfile(filename_dict + ".lock"):
+            os.remove(filename_dict + ".lock")
+        print("Index " + filename_dict + " imported in " + DATABASE_NAME)
+
+
+def save_payload(path: str, res) -> None:
+    """
+        Stores res in the folder path. The arrays inside res
+        (possibly inside tuples, lists, dicts, NamedTuples) are
+        saved as raw .npy files; a list of arrays of same shape
+        is stacked in one file. The structure and the other
+        objects are pickled in path/manifest.npy.
+        Inside the cache, the .npy files are hard links to
+        LEAVES_FOLDER_NAME (see _save_leaf).
+        The folder is replaced atomically.
+        Must be called with _locked(path).
+    """
+    directory = tempfile.mkdtemp(dir=os.path.dirname(path),
+            suffix=".tmp")
+    shared = os.path.dirname(os.path.dirname(os.path.abspath(path))) \
+            == os.path.abspath(MEMOISATION_FOLDER_NAME)
+    try:
+        leaves = []
+        manifest = _split_leaves(res, leaves)
+        for i, leaf in enumerate(leaves):
+            _save_leaf(os.path.join(directory, "leaf_" + str(i) + ".npy"),
+                    leaf, shared)
+        np.save(os.path.join(directory, "manifest.npy"),
+                {KEY_FOR_UNIQUE_ITEM: manifest})
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(directory, path)
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+
+
+def _save_leaf(filename: str, leaf: np.ndarray, shared: bool) -> None:
+    """
+        saves the array leaf in filename (raw .npy). If shared,
+        filename is a hard link to LEAVES_FOLDER_NAME/<digest>.npy:
+        the equal arrays of different results use the same file.
+        The files of LEAVES_FOLDER_NAME are never modified
+        (see _collect_leaves for their deletion).
+    """
+    if shared:
+        os.makedirs(LEAVES_FOLDER_NAME, exist_ok=True)
+        pooled = os.path.join(LEAVES_FOLDER_NAME, stable_key(leaf) + ".npy")
+        for _ in range(3):
+            if not os.path.isfile(pooled):
+                with tempfile.NamedTemporaryFile(dir=LEAVES_FOLDER_NAME,
+                        suffix=".tmp", delete=False) as leaf_file:
+                    np.save(leaf_file, leaf, allow_pickle=False)
+                os.replace(leaf_file.name, pooled)
+            try:
+                os.link(pooled, filename)
+                return
+            except FileNotFoundError: # deleted by _collect_leaves
+                continue
+            except OSError: # no hard links on this file system
+                break
+    np.save(filename, leaf, allow_pickle=False)
+
+
+def _collect_leaves() -> None:
+    """
+        deletes the files of LEAVES_FOLDER_NAME which are not
+        linked by any result anymore (and the temporary files
+        left by crashed processes).
+    """
+    if not os.path.isdir(LEAVES_FOLDER_NAME):
+        return
+    for entry in os.scandir(LEAVES_FOLDER_NAME):
+        try:
+            if entry.name.endswith(".npy") and entry.stat().st_nlink == 1 \
+                    or entry.name.endswith(".tmp") and \
+                    time.time() - entry.stat().st_mtime > 86400:
+                os.remove(entry.path)
+        except FileNotFoundError: # an other process deleted it
+            pass
+
+
+def load_payload(path: str):
+    """
+        Loads a result stored by save_payload. The big arrays are
+        memory-mapped (see MMAP_MODE): they are read lazily.
+        Results stored in a single .npy file
+        (old versions of this module) are also accepted.
+    """
+    if path.endswith(".npy"):
+        return np.load(path, allow_pickle=True)[()][KEY_FOR_UNIQUE_ITEM]
+    manifest = np.load(os.path.join(path, "manifest.npy"),
+            allow_pickle=True)[()][KEY_FOR_UNIQUE_ITEM]
+    return _join_leaves(manifest, path)
+
+
+class SpilledDict(MutableMapping):
+    """
+        dict stored on the disk (with save_payload) until its first
+        access, where it is loaded with memory maps. The items
+        modified afterwards are kept in memory. It becomes a normal
+        dict (in memory) when it is pickled or memoised.
+        The files are deleted with the object.
+        folder: where the files are stored (default: see tempfile)
+    """
+    MEMOISATION_SPLIT = True # see save_payload
+
+    def __init__(self, dictionary: dict, folder: str=None):
+        directory = tempfile.mkdtemp(prefix="spilled_", dir=folder)
+        self.path = os.path.join(directory, "payload")
+        save_payload(self.path, dict(dictionary))
+        self.items_loaded = None
+        weakref.finalize(self, shutil.rmtree, directory, True)
+
+    def loaded(self) -> dict:
+        """ the dict, loaded from the disk if needed """
+        if self.items_loaded is None:
+            self.items_loaded = load_payload(self.path)
+        return self.items_loaded
+
+    def __getitem__(self, key):
+        return self.loaded()[key]
+
+    def __setitem__(self, key, value):
+        self.loaded()[key] = value
+
+    def __delitem__(self, key):
+        del self.loaded()[key]
+
+    def __iter__(self):
+        return iter(self.loaded())
+
+    def __len__(self) -> int:
+        return len(self.loaded())
+
+    def __getstate__(self) -> dict:
+        return {"items": dict(self.loaded())}
+
+    def __setstate__(self, state: dict) -> None:
+        self.path = None
+        self.items_loaded = dict(state["items"])
+
+
+def _split_leaves(obj, leaves: list):
+    """
+        returns the description of the structure of obj;
+        the arrays are replaced by their index in leaves.
+    """
+    if _is_leaf(obj):
+        leaves.append(obj)
+        return ("array", len(leaves) - 1)
+    if type(obj) is list and len(obj) > 1 and _is_leaf(obj[0]) \
+            and all(_is_leaf(arr) and arr.shape == obj[0].shape
+                    and arr.dtype == obj[0].dtype for arr in obj):
+        leaves.append(np.stack(obj))
+        return ("stack", len(leaves) - 1)
+    if isinstance(obj, tuple) and hasattr(obj, "_fields"): # NamedTuple
+        return ("namedtuple", type(obj),
+                [_split_leaves(item, leaves) for item in obj])
+    if type(obj) in {tuple, list}:
+        return (type(obj).__name__,
+                [_split_leaves(item, leaves) for item in obj])
+    if isinstance(obj, (tuple, list)): # rebuilt with type(obj)(items)
+        return ("sequence", type(obj),
+                [_split_leaves(item, leaves) for item in obj])
+    if type(obj) is dict:
+        return ("dict", [(key, _split_leaves(val, leaves))
+            for key, val in obj.items()])
+    if getattr(type(obj), "MEMOISATION_SPLIT", False):
+        # the class opts in: its state is split like a dict
+        return ("state", type(obj),
+                _split_leaves(obj.__getstate__(), leaves))
+    return ("object", obj)
+
+
+def _is_leaf(obj) -> bool:
+    """ True if obj is an array that can be stored in a raw .npy """
+    return isinstance(obj, np.ndarray) and obj.dtype != object \
+            and obj.size > 0 and obj.ndim > 0
+
+
+def _join_leaves(node, path: str):
+    """ inverse of _split_leaves: rebuilds the object """
+    kind = node[0]
+    if kind in {"array", "stack"}:
+        filename = os.path.join(path, "leaf_" + str(node[1]) + ".npy")
+        mmap_mode = MMAP_MODE if os.path.getsize(filename) >= \
+                MMAP_MIN_BYTES else None
+        arr = np.load(filename, mmap_mode=mmap_mode)
+        return arr if kind == "array" else list(arr)
+    if kind == "namedtuple":
+        return node[1](*(_join_leaves(item, path) for item in node[2]))
+    if kind == "tuple":
+        return tuple(_join_leaves(item, path) for item in node[1])
+    if kind == "list":
+        return [_join_leaves(item, path) for item in node[1]]
+    if kind == "sequence":
+        return node[1]([_join_leaves(item, path) for item in node[2]])
+    if kind == "dict":
+        return {key: _join_leaves(val, path) for key, val in node[1]}
+    if kind == "state":
+        obj = node[1].__new__(node[1])
+        obj.__setstate__(_join_leaves(node[2], path))
+        return obj
+    return node[1]
+
+
+def _payload_size(path: str) -> int:
+    """
+        number of bytes used by a result (file or folder).
+        The files shared with other results (see _save_leaf) are
+        divided between them.
+    """
+    if os.path.isdir(path):
+        return int(sum(entry.stat().st_size /
+            max(entry.stat().st_nlink - 1, 1)
+            for entry in os.scandir(path)))
+    return os.path.getsize(path)
+
+
+@contextmanager
+def _locked(filename: str, remove: bool=False):
+    """
+        Advisory lock (see flock(2)) on filename + ".lock".
+        The lock is released by the kernel if the process dies.
+        If remove is True, the lock file is deleted before the
+        lock is released (see _lock_file).
+    """
+    lock_file = _lock_file(filename + ".lock")
+    try:
+        yield
+    finally:
+        if remove:
+            os.remove(filename + ".lock")
+        lock_file.close() # releases the lock
+
+
+def _lock_file(path: str, blocking: bool=True):
+    """
+        opens path and takes an exclusive flock on it.
+        returns the open file (closing it releases the lock), or
+        None if blocking is False and an other process holds it.
+        A lock file can be deleted by the process holding its lock:
+        the lock taken on a deleted file is then taken again on
+        the file now at path, so that all the processes lock the
+        same file.
+    """
+    flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+    while True:
+        lock_file = open(path, "a")
+        try:
+            fcntl.flock(lock_file, flags)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        try:
+            if os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                return lock_file
+        except FileNotFoundError:
+            pass
+        lock_file.close()
+
+
+@contextmanager
+def _in_flight(filename: str, fun_name: str):
+    """
+        Registers the computation of the result filename:
+        while it is registered, the other processes which miss
+        on the same entry wait for it instead of computing it.
+        Yields True if it had to wait for an other process (the
+        result should then be looked up again), False otherwise.
+        The registration is a lock on filename + ".computing"
+        (released by the kernel if the worker crashes) and a file
+        filename + ".inflight" telling who computes it. Both files
+        are deleted at the end.
+    """
+    registry, computing = filename + ".inflight", filename + ".computing"
+    lock_file = _lock_file(computing, blocking=False)
+    waited = lock_file is None
+    if waited:
+        owner = _read_registration(registry)
+        print("Waiting for " + fun_name + ", computed by " +
+                (owner if owner is not None else "an other process")
+                + "...")
+        lock_file = _lock_file(computing)
+    elif os.path.isfile(registry):
+        # the lock was free: the registered worker crashed
+        print("Reclaiming the stale registration " + registry)
+    with open(registry, "w") as registration:
+        registration.write(" ".join((str(os.getpid()),
+            os.uname().nodename, str(time.time()))))
+    try:
+        yield waited
+    finally:
+        if os.path.isfile(registry):
+            os.remove(registry)
+        os.remove(computing) # while the lock is held (see _lock_file)
+        lock_file.close()
+
+
+def _read_registration(registry: str):
+    """ returns "pid <pid> on <host> since <duration>" or None """
+    try:
+        with open(registry) as registration:
+            pid, host, start = registration.read().split()
+    except (OSError, ValueError):
+        return None
+    return "pid " + pid + " on " + host + " since " + \
+            str(int(time.time() - float(start))) + "s"
+
+
+def in_flight() -> list:
+    """
+        returns the list of (fun, key, owner) of the computations
+        which are currently registered by memoised.
+        The stale registrations of crashed workers are removed.
+    """
+    ret = []
+    for registry in glob.glob(MEMOISATION_FOLDER_NAME + "/*/*.inflight"):
+        filename = registry[:-len(".inflight")]
+        lock_file = _lock_file(filename + ".computing", blocking=False)
+        if lock_file is None:
+            ret.append((os.path.basename(os.path.dirname(filename)),
+                os.path.basename(filename),
+                _read_registration(registry)))
+            continue
+        if os.path.isfile(registry):
+            os.remove(registry)
+        os.remove(filename + ".computing")
+        lock_file.close()
+    return ret
+
+
+def stable_key(key_dic) -> str:
+    """
+        returns a digest of key_dic that does not depend
+        on the process (contrary to hash(), which is salted
+        for strings). key_dic is canonicalised with _canonical.
+    """
+    return hashlib.sha256(_canonical(key_dic)).hexdigest()
+
+
+def _canonical(obj) -> bytes:
+    """
+        Serialization of obj which only depends on its content.
+        Integers are encoded as floats when it is exact so that
+        memoised(f, 1) and memoised(f, 1.) share the same entry,
+        as it was the case with the old hash-based index.
+    """
+    if obj is None:
+        return b"N"
+    if isinstance(obj, (bool, np.bool_)):
+        return b"B1" if obj else b"B0"
+    if isinstance(obj, numbers.Integral) and float(obj) != obj:
+        return b"I" + str(int(obj)).encode()
+    if isinstance(obj, numbers.Real):
+        # adding 0. replaces -0. by 0. (they were equal keys before)
+        return b"F" + repr(float(obj) + 0.).encode()
+    if isinstance(obj, numbers.Complex):
+        return b"C" + _canonical(obj.real) + _canonical(obj.imag)
+    if isinstance(obj, str):
+        encoded = obj.encode("utf-8")
+        return b"S" + str(len(encoded)).encode() + b":" + encoded
+    if isinstance(obj, bytes):
+        return b"Y" + str(len(obj)).encode() + b":" + obj
+    if isinstance(obj, np.ndarray):
+        arr = np.ascontiguousarray(obj)
+        header = arr.dtype.str + repr(arr.shape)
+        return b"A" + _canonical(header) + \
+                _canonical(hashlib.sha256(arr.tobytes()).hexdigest())
+    if isinstance(obj, FunMem):
+        return b"M" + _canonical(_qualified_name(obj.fun))
+    if isinstance(obj, tuple) and hasattr(obj, "_fields"): # NamedTuple
+        return b"Q" + _canonical(_qualified_name(type(obj))) + \
+                _canonical(tuple(obj))
+    if isinstance(obj, (tuple, list)):
+        tag = b"T" if isinstance(obj, tuple) else b"L"
+        return tag + str(len(obj)).encode() + b"(" + \
+                b",".join(_canonical(item) for item in obj) + b")"
+    if isinstance(obj, dict):
+        items = sorted((_canonical(key), _canonical(val))
+                for key, val in obj.items())
+        return b"D" + str(len(items)).encode() + b"(" + \
+                b",".join(key + b":" + val for key, val in items) + b")"
+    if callable(obj) and hasattr(obj, "__qualname__"):
+        return b"M" + _canonical(_qualified_name(obj))
+    if type(obj).__repr__ is not object.__repr__:
+        return b"R" + _canonical(_qualified_name(type(obj))) + \
+                _canonical(repr(obj))
+    raise TypeError("Cannot memoise an argument of type " +
+            type(obj).__name__ + ": implement its __repr__.")
+
+
+def _qualified_name(obj) -> str:
+    """ name of a function or a class, including its module """
+    return getattr(obj, "__module__", "") + "." + obj.__qualname__
+
+
+def _load_npy_index(filename_dict: str, directory: str) -> dict:
+    """
+        loads an old index of a memoised function.
+        Indexes written by the oldest versions of this module
+        (keys were the arguments themselves and files were
+        named with hash()) are migrated to the stable keys.
+    """
     try:
         dic = np.load(filename_dict, allow_pickle=True)[()]
     except IOError:  # there is no index yet !
-        dic = {}
-    dic[key_dic] = filename_res
-    np.save(filename_dict, dic)
-    # Finally, we can compute and store our result.
-    res = fun(*args_mem, **kwargs_mem)
-    # We use a dictionnary to store because we don't know type(res)
-    to_store = {KEY_FOR_UNIQUE_ITEM: res}
-    np.save(filename_res, to_store)
-    return res
+        return {}
+    migrated = {}
+    for key_dic, filename in dic.items():
+        key = key_dic if isinstance(key_dic, str) else stable_key(key_dic)
+        new_filename = directory + "/" + key + ".npy"
+        if filename != new_filename and os.path.isfile(filename):
+            os.replace(filename, new_filename)
+        migrated[key] = new_filename
+    return migrated
 
 
 class FunMem():
@@ -10,10 +10,12 @@ import numpy as np
 from tqdm import tqdm
 from scipy import integrate
 import warnings
-from utils_linalg import multiply, scal_multiply as s_mult
-from utils_linalg import add_banded as add
+from utils_linalg import multiply, BandedMatrix, bands
+from utils_linalg import solve_systems
 from utils_linalg import solve_linear, orientation
 from utils_linalg import full_to_half
+from trajectory import Trajectory
+from checkpoint import Checkpointer
 from universal_functions import Businger_et_al_1971 as businger
 from universal_functions import Large_et_al_2019 as large_ocean
 from shortwave_absorption import shortwave_fractional_decay, \
@@ -74,6 +76,10 @@ class Ocean1dStratified():
         self.N0 = N0
         self.alpha: float = alpha
         self.implicit_coriolis: float = 0.55 # semi-implicit coefficient
+        self.__to_inverse = {} # buffers of __backward_euler (by field)
+        # solver of the momentum and temperature systems, one of
+        # utils_linalg.BACKENDS (None: utils_linalg.COMPLEX_BACKEND)
+        self.backend: str = None
         self.mxl_min: float = self.K_mol / ( self.C_m * np.sqrt(self.e_min) )
         self.dict_tau_sl = {}
         # For each name of sf_scheme, two corresponding
@@ -125,7 +131,8 @@ class Ocean1dStratified():
             wind_10m: array, temp_10m: array,
             delta_sl: float=None,
             sf_scheme: str="FV test", Neutral_case: bool=False,
-            turbulence: str="TKE", store_all: bool=False):
+            turbulence: str="TKE", store_all: bool=False,
+            restart: dict=None, checkpoint: Checkpointer=None):
         """
             Integrates in time with Backward Euler the model with TKE
             and Finite volumes.
@@ -149,6 +156,12 @@ class Ocean1dStratified():
                 - "KPP" (for simple K-profile parametrization)
             If Neutral_case is True, no temperature profile
             is computed and t_star = 0
+            restart: ret_dict['restart'] of a previous integration
+                (turbulent state at its last time step) to continue
+                it: u_t0, theta_t0,... should then be its last state.
+            checkpoint: saves the state every checkpoint.interval
+                time steps; if it holds a checkpoint, the
+                integration resumes from it.
         """
         assert u_t0.shape[0] == self.M
         assert phi_t0.shape[0] == self.M + 1
@@ -197,11 +210,28 @@ class Ocean1dStratified():
         u_current: array = np.copy(u_t0)
         all_u_star = []
         ret_u_delta, ret_t_delta = [u_delta], [t_delta]
-        ret_u_current, ret_tke, ret_SL = [], [], []
-        ret_phi, ret_theta, ret_dz_theta, ret_leps = [], [], [], []
-
-        for n in tqdm(range(1,N+1), total=N, leave=False) \
-                if self.loading_bar else range(1,N+1):
+        ret_u_current, ret_tke, ret_SL = Trajectory(), Trajectory(), []
+        ret_phi, ret_theta, ret_dz_theta, ret_leps = Trajectory(), \
+                Trajectory(), Trajectory(), Trajectory()
+
+        n_start: int = 1
+        saved = checkpoint.load() if checkpoint is not None else None
+        if saved is not None: # resumes an interrupted integration
+            n_start, restart = saved["n"] + 1, saved["restart"]
+            u_current, phi, theta, dz_theta = saved["prognostic"]
+            u_delta, t_delta, SL = saved["surface"]
+            all_u_star, ret_u_delta, ret_t_delta, ret_SL = saved["lists"]
+            (ret_u_current, ret_tke, ret_phi, ret_theta, ret_dz_theta,
+                    ret_leps) = saved["trajectories"]
+        if restart is not None: # continues a previous integration
+            tke.tke_full = np.copy(restart["tke"])
+            Ku_full = np.copy(restart["Ku"])
+            Ktheta_full = np.copy(restart["Ktheta"])
+            l_m, l_eps = np.copy(restart["l_m"]), np.copy(restart["l_eps"])
+            old_phi = np.copy(restart["old_phi"])
+        for n in tqdm(range(n_start,N+1), total=N+1-n_start,
+                leave=False) \
+                if self.loading_bar else range(n_start,N+1):
             # Compute friction scales:
             SL_nm1 = SL
             SL = process_friction_scales_oce(ua_delta=wind_10m[n],
@@ -263,14 +293,25 @@ class Ocean1dStratified():
             ret_t_delta += [t_delta]
 
             if store_all:
-                ret_u_current += [np.copy(u_current)]
-                ret_tke += [np.copy(tke.tke_full)]
-                ret_phi += [np.copy(phi)]
-                ret_theta += [np.copy(theta)]
-                ret_dz_theta += [np.copy(dz_theta)]
-                ret_leps += [np.copy(l_eps)]
+                ret_u_current.append(u_current)
+                ret_tke.append(tke.tke_full)
+                ret_phi.append(phi)
+                ret_theta.append(theta)
+                ret_dz_theta.append(dz_theta)
+                ret_leps.append(l_eps)
                 ret_SL += [SL]
 
+            if checkpoint is not None and checkpoint.due(n):
+                checkpoint.save(n, {"n": n,
+                    "restart": {"tke": tke.tke_full, "Ku": Ku_full,
+                        "Ktheta": Ktheta_full, "l_m": l_m,
+                        "l_eps": l_eps, "old_phi": old_phi},
+                    "prognostic": (u_current, phi, theta, dz_theta),
+                    "surface": (u_delta, t_delta, SL),
+                    "lists": (all_u_star, ret_u_delta, ret_t_delta, ret_SL),
+                    "trajectories": (ret_u_current, ret_tke, ret_phi,
+                        ret_theta, ret_dz_theta, ret_leps)})
+
         ret_dict = {'u_delta' : ret_u_delta,
                 't_delta': ret_t_delta,}
         if store_all:
@@ -292,6 +333,9 @@ class Ocean1dStratified():
         ret_dict['l_eps'] = l_eps
         ret_dict['SL'] = SL
         ret_dict['Ktheta'] = Ktheta_full
+        ret_dict['restart'] = {"tke": tke.tke_full, "Ku": Ku_full,
+                "Ktheta": Ktheta_full, "l_m": l_m, "l_eps": l_eps,
+                "old_phi": old_phi}
         return ret_dict
 
     def FD(self, u_t0: array, theta_t0: array,
@@ -300,7 +344,8 @@ class Ocean1dStratified():
             u_star: array, t_star: array,
             delta_sl_a: float=10.,
             turbulence: str="TKE", sf_scheme: str="FD pure",
-            Neutral_case: bool=False, store_all: bool=False):
+            Neutral_case: bool=False, store_all: bool=False,
+            restart: dict=None, checkpoint: Checkpointer=None):
         """
             Integrates in time with Backward Euler the model with KPP
             and Finite differences.
@@ -317,6 +362,12 @@ class Ocean1dStratified():
                 "FD2"     (delta_sl = z_1)
             If Neutral_case is True, no temperature profile
             is computed and t_star = 0
+            restart: ret_dict['restart'] of a previous integration
+                (turbulent state at its last time step) to continue
+                it: u_t0, theta_t0,... should then be its last state.
+            checkpoint: saves the state every checkpoint.interval
+                time steps; if it holds a checkpoint, the
+                integration resumes from it.
         """
         assert u_t0.shape[0] == self.M
         assert sf_scheme in self.dictsf_scheme_theta
@@ -351,10 +402,26 @@ class Ocean1dStratified():
         u_current: array = np.copy(u_t0)
         old_u: array = np.copy(u_current)
         all_u_star = []
-        all_u, all_tke, all_theta, all_leps = [], [], [], []
+        all_u, all_tke, all_theta, all_leps = Trajectory(), \
+                Trajectory(), Trajectory(), Trajectory()
         ret_u_delta, ret_t_delta = [], []
-        for n in tqdm(range(1,N+1), total=N, leave=False) \
-                if self.loading_bar else range(1,N+1):
+        n_start: int = 1
+        saved = checkpoint.load() if checkpoint is not None else None
+        if saved is not None: # resumes an interrupted integration
+            n_start, restart = saved["n"] + 1, saved["restart"]
+            u_current, theta = saved["prognostic"]
+            SL = saved["SL"]
+            all_u_star, ret_u_delta, ret_t_delta = saved["lists"]
+            all_u, all_tke, all_theta, all_leps = saved["trajectories"]
+        if restart is not None: # continues a previous integration
+            tke.tke_full = np.copy(restart["tke"])
+            Ku_full = np.copy(restart["Ku"])
+            Ktheta_full = np.copy(restart["Ktheta"])
+            l_m, l_eps = np.copy(restart["l_m"]), np.copy(restart["l_eps"])
+            old_u = np.copy(restart["old_u"])
+        for n in tqdm(range(n_start,N+1), total=N+1-n_start,
+                leave=False) \
+                if self.loading_bar else range(n_start,N+1):
             u_delta = func_un(prognostic=u_current, delta_sl=delta_sl)
             t_delta = func_theta(prognostic=theta)
             SL = process_friction_scales_oce(ua_delta=wind_10m[n],
@@ -380,9 +447,8 @@ class Ocean1dStratified():
             self.__apply_sf_scheme(Y=Y, D=D, c=c, K_u=Ku_full,
                     func=self.dictsf_scheme[sf_scheme][1],
                     forcing=forcing[n], SL=SL)
-            next_u = self.__backward_euler(Y=Y, D=D, c=c,
-                    u=u_current, f=self.f)
-            u_current, old_u = next_u, u_current
+            systems = [self.__backward_euler(Y=Y, D=D, c=c,
+                    u=u_current, f=self.f, solve=False)]
 
             if not Neutral_case:
                 swr_frac = shortwave_fractional_decay(self.M,
@@ -399,16 +465,35 @@ class Ocean1dStratified():
                         universal_funcs=large_ocean,
                         universal_funcs_a=businger)
 
-                theta = np.real(self.__backward_euler(Y=Y_theta,
-                        D=D_theta, c=c_theta, u=theta, f=0.))
+                systems += [self.__backward_euler(Y=Y_theta,
+                        D=D_theta, c=c_theta, u=theta, f=0., solve=False,
+                        field="theta")]
+
+            # momentum and temperature are solved at once:
+            next_u, *next_theta = solve_systems(systems,
+                    backend=self.backend)
+            u_current, old_u = next_u, u_current
+            if not Neutral_case:
+                theta = np.real(next_theta[0])
             ret_u_delta += [u_delta]
             ret_t_delta += [t_delta]
 
             if store_all:
-                all_u += [np.copy(u_current)]
-                all_tke += [np.copy(tke.tke_full)]
-                all_theta += [np.copy(theta)]
-                all_leps += [np.copy(l_eps)]
+                all_u.append(u_current)
+                all_tke.append(tke.tke_full)
+                all_theta.append(theta)
+                all_leps.append(l_eps)
+
+            if checkpoint is not None and checkpoint.due(n):
+                checkpoint.save(n, {"n": n,
+                    "restart": {"tke": tke.tke_full, "Ku": Ku_full,
+                        "Ktheta": Ktheta_full, "l_m": l_m,
+                        "l_eps": l_eps, "old_u": old_u},
+                    "prognostic": (u_current, theta),
+                    "SL": SL,
+                    "lists": (all_u_star, ret_u_delta, ret_t_delta),
+                    "trajectories": (all_u, all_tke, all_theta,
+                        all_leps)})
 
         ret_u_delta += [func_un(prognostic=u_current,
                                 delta_sl=delta_sl)]
@@ -430,6 +515,9 @@ class Ocean1dStratified():
         ret_dict['l_eps'] = l_eps
         ret_dict['SL'] = SL
         ret_dict['Ktheta'] = Ktheta_full
+        ret_dict['restart'] = {"tke": tke.tke_full, "Ku": Ku_full,
+                "Ktheta": Ktheta_full, "l_m": l_m, "l_eps": l_eps,
+                "old_u": old_u}
         return ret_dict
 
     def __step_u(self, u: array, phi: array,
@@ -498,7 +586,7 @@ class Ocean1dStratified():
         tilde_h = SL.delta_sl - self.z_full[SL.k-1]
         prognostic_theta[:] = np.real(self.__backward_euler(Y=Y_theta,
                 D=D_theta, c=c_theta, u=prognostic_theta, f=0.,
-                Y_nm1=Y_nm1))
+                Y_nm1=Y_nm1, field="theta"))
 
         next_theta = np.zeros_like(theta)
         next_theta[:SL.k] = theta[:SL.k] + self.dt * \
@@ -729,7 +817,8 @@ class Ocean1dStratified():
 
     def __backward_euler(self, Y: Tuple[array, array, array],
                         D: Tuple[array, array, array], c: array,
-                        u: array, f:float=0., Y_nm1=None):
+                        u: array, f:float=0., Y_nm1=None,
+                        solve: bool=True, field: str="u"):
         """
             if it's for $u$, set f=self.f otherwise f=0
             integrates once (self.dt) in time the equation
@@ -738,15 +827,31 @@ class Ocean1dStratified():
             Y(1+dt*if*gamma) - D) u_np1 = Y u + dt*c + dt*if*(1-gamma)
             with gamma the coefficient of implicitation of Coriolis.
             If partial_t Y is not zero, then Y_nm1 != Y can be given.
+            If solve is False, the system (BandedMatrix, rhs) is
+            returned instead of its solution (see solve_systems).
+            The system is solved with self.backend.
+            field ("u" or "theta") selects the buffer of the matrix:
+            both systems can be assembled before being solved.
         """
         if Y_nm1 is None:
             Y_nm1=Y
-        to_inverse: Tuple[array, array, array] = add(s_mult(Y,
-                                1 + self.implicit_coriolis * \
-                            self.dt * 1j*f), s_mult(D, - self.dt))
-        return solve_linear(to_inverse,
+        # with the real backend, the systems without Coriolis are real:
+        dtype = np.result_type(*Y, *D, np.float64) if f == 0 and \
+                self.backend == "real blocks" else np.complex128
+        # the matrix is built in the buffer of the previous step:
+        self.__to_inverse[field] = BandedMatrix.from_diagonals(Y,
+                shape_bands=tuple(map(max, bands(Y), bands(D))),
+                dtype=dtype, out=self.__to_inverse.get(field))
+        to_inverse: BandedMatrix = self.__to_inverse[field]
+        if f != 0:
+            to_inverse.scale(1 + self.implicit_coriolis * self.dt * 1j*f)
+        to_inverse.add(D, -self.dt)
+        rhs: array = multiply(Y_nm1, u) + self.dt*c if f == 0 else \
                 (1 - (1 - self.implicit_coriolis) * self.dt*1j*f) * \
-                                multiply(Y_nm1, u) + self.dt*c)
+                                multiply(Y_nm1, u) + self.dt*c
+        if not solve:
+            return to_inverse, rhs
+        return to_inverse.solve(rhs, overwrite=True, backend=self.backend)
 
     def __visc_turb_FD(self, SL: SurfaceLayerData,
             turbulence: str="TKE", u_current: array=None,
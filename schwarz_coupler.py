@@ -2,15 +2,36 @@
 """
     This module is here to simulate the OA coupling.
 """
-from typing import NamedTuple, List, Dict
+import os
+import time
+import numbers
+import functools
+import multiprocessing
+import contextlib
+from typing import NamedTuple, List, Dict, Tuple
 from tqdm import tqdm
 import numpy as np
-from scipy import interpolate
+import memoisation
+from checkpoint import Checkpointer
 from atm1DStratified import Atm1dStratified
 from ocean1DStratified import Ocean1dStratified
+from bulk import friction_scales
+from universal_functions import Businger_et_al_1971 as businger
+from universal_functions import Large_et_al_2019 as large_ocean
 
 INIT_U_OCE = 0. + 0j
 INIT_THETA_OCE = 280.
+INIT_THETA_ATM = 280.
+# maximal number of passes of the FV free initialization of the
+# atmosphere (a cold start does all of them). A warm start stops
+# once its relative accuracy is INIT_TOLERANCE_RATIO times the
+# last interface change of the Schwarz iterations: the error of
+# the initialization then decreases as fast as the Schwarz
+# iterations converge, and does not limit their convergence.
+INIT_MAX_ITER = 15
+INIT_TOLERANCE_RATIO = 1e-4
+# simulators of the workers of the pools (inherited when forked):
+_pool_simulators = None
 
 class StateOce(NamedTuple):
     """
@@ -45,41 +66,593 @@ class NumericalSetting(NamedTuple):
     delta_sl_o: float # height of the bottom of OSL (<0)
     Q_sw: np.ndarray # shortwave radiative flux in ocean
     Q_lw: np.ndarray # shortwave radiative flux in ocean
+    t_start: float = 0. # time (in seconds) of the beginning
+
+class Relaxation(NamedTuple):
+    """
+        relaxation of the ocean interface data (u_delta, t_delta)
+        given to the atmosphere by schwarz_coupling.
+        method is one of:
+        - "fixed": x <- x + omega * (G(x) - x)
+        - "aitken": same with omega updated by Aitken's delta^2
+        - "anderson": Anderson mixing over the last depth iterates
+            (omega is the damping of the mixing)
+    """
+    method: str = "fixed"
+    omega: float = 0.5 # (initial) relaxation parameter
+    depth: int = 3 # number of iterates used by "anderson"
+
+RELAXATION_METHODS = ("fixed", "aitken", "anderson")
 
 
 def schwarz_coupling(simulator_oce: Ocean1dStratified,
         simulator_atm: Atm1dStratified,
         parameters: NumericalSetting,
         NUMBER_SCHWARZ_ITERATION: int=1,
+        cache_iterations: bool=False,
+        tolerance: float=None, norm=np.inf,
+        relaxation: Relaxation=None,
+        initial_state: Tuple[Dict, Dict]=None,
+        first_guess: StateOce=None,
+        jacobi: bool=False,
+        keep_full="last",
+        checkpoint_folder: str=None, checkpoint_interval: int=1000,
         **kwargs)-> (List[StateAtm], List[StateOce]):
     """
         computes the coupling between the two models
         Atm1dStratified and Ocean1dStratified.
         If NUMBER_SCHWARZ_ITERATION is zero,
         only returns the atmosphere state.
+        If cache_iterations is True, each iteration is stored
+        in the cache (see memoisation.store): the computation
+        resumes from the last iteration already computed
+        with the same setting. A result memoised afterwards (e.g.
+        by figures.simulation_coupling) shares the arrays of
+        these iterations instead of copying them.
+        If tolerance is given, NUMBER_SCHWARZ_ITERATION is the
+        maximal number of iterations: the coupling stops when
+        the interface_change between two iterates is below
+        tolerance. The list of the interface changes
+        is then returned as a third element.
+        norm is the ord of np.linalg.norm used in interface_change.
+        If relaxation is given, the ocean interface data given to
+        the atmosphere is relaxed (see Relaxation). The states
+        returned are the raw outputs of the models.
+        initial_state is the (atmosphere, ocean) last_tstep of
+        a previous integration to start from, and first_guess
+        the ocean state given to the first atmosphere integration
+        (default: initialization_ocean).
+        If jacobi is True, the two models of an iteration run
+        at the same time in two processes, each one using the
+        previous iterate of the other (the first atmosphere
+        iterate given to the ocean is initialization_atmosphere).
+        Otherwise (Gauss-Seidel), the ocean uses the atmosphere
+        of the same iteration.
+        keep_full tells which iterates keep their "other" in
+        memory: "all", "last" or a collection of iteration numbers
+        (the last one is also kept). The "other" of the other
+        iterates are spilled to the disk and loaded when they are
+        accessed (see memoisation.SpilledDict); the interface
+        series and last_tstep are always kept.
+        If checkpoint_folder is given, the coupling is saved in
+        it after each iteration and the models save their state
+        every checkpoint_interval time steps (see Checkpointer):
+        an interrupted coupling with the same setting resumes from
+        its last checkpoint. The checkpoints are deleted at the end.
     """
+    initial_atm, initial_oce = (None, None) if initial_state is None \
+            else initial_state
     oce_state, atm_state = [initialization_ocean(parameters,
-        simulator_oce)], []
+        simulator_oce) if first_guess is None else first_guess], []
     if NUMBER_SCHWARZ_ITERATION == 0: # only atmosphere
         return compute_atmosphere(simulator_atm,
-                oce_state[-1], parameters, **kwargs)
-    with tqdm(total=NUMBER_SCHWARZ_ITERATION*2, leave=False) as pbar:
-        for _ in range(NUMBER_SCHWARZ_ITERATION):
-            atm_state += [compute_atmosphere(simulator_atm,
-                oce_state[-1], parameters, **kwargs)]
-            pbar.update(1)
-            oce_state += [compute_ocean(simulator_oce,
-                atm_state[-1], parameters, **kwargs)]
-            pbar.update(1)
+                oce_state[-1], parameters, initial=initial_atm, **kwargs)
+    if relaxation is not None and \
+            relaxation.method not in RELAXATION_METHODS:
+        raise NotImplementedError("Unknown relaxation " +
+                relaxation.method)
+    key = _iteration_key(simulator_oce, simulator_atm, parameters, kwargs)
+    if relaxation is not None:
+        key += (relaxation,)
+    if initial_state is not None or first_guess is not None:
+        key += (initial_state, first_guess)
+    if jacobi:
+        key += ("jacobi",)
+    history = []
+    resuming = cache_iterations # looking for cached iterations
+    memory = {} # state of the relaxation
+    first_iteration = 0
+    checkpoints = None if checkpoint_folder is None else Checkpointer(
+            os.path.join(checkpoint_folder, memoisation.stable_key((key,
+                memoisation.source_fingerprint(schwarz_coupling, *key)))),
+            checkpoint_interval)
+    saved = checkpoints.load() if checkpoints is not None else None
+    if saved is not None: # resumes an interrupted coupling
+        atm_state, oce_state = saved["atm"], saved["oce"]
+        memory, history = saved["memory"], saved["history"]
+        first_iteration = saved["iteration"] + 1
+        if tolerance is not None and history and history[-1] < tolerance:
+            first_iteration = NUMBER_SCHWARZ_ITERATION
+    oce_input = oce_state[-1] if relaxation is None or not memory else \
+            _from_interface_vector(memory["inputs"][-1], oce_state[-1])
+
+    # the workers are terminated when leaving the block (even after
+    # an exception); all the results have been received then.
+    with (_forked_pool(simulator_oce, simulator_atm) if jacobi else
+            contextlib.nullcontext()) as pool, \
+            tqdm(total=NUMBER_SCHWARZ_ITERATION*2, leave=False,
+            initial=first_iteration*2) as pbar:
+        for iteration in range(first_iteration, NUMBER_SCHWARZ_ITERATION):
+            cached = memoisation.lookup(schwarz_coupling, *key,
+                    iteration=iteration) if resuming else None
+            if cached is not None:
+                atm_state += [cached[0]]
+                oce_state += [cached[1]]
+                if relaxation is not None:
+                    memory = cached[2]
+                pbar.update(2)
+            else:
+                resuming = False
+                start = time.time()
+                models_kwargs = [kwargs, kwargs]
+                if checkpoints is not None:
+                    models_kwargs = [dict(kwargs, checkpoint=checkpoints.
+                        child("iteration_" + str(iteration)).child(model))
+                        for model in ("atm", "oce")]
+                if atm_state: # warm start of the initialization
+                    models_kwargs[0] = dict(models_kwargs[0], warm_start=
+                            atm_state[-1].other.get("initialization"),
+                            init_tolerance=INIT_TOLERANCE_RATIO *
+                            history[-1] if history else None)
+                if pool is not None:
+                    atm_input = atm_state[-1] if atm_state else \
+                            initialization_atmosphere(parameters,
+                                    simulator_atm, oce_state[0])
+                    atm_job = pool.apply_async(_jacobi_task, ("atm",
+                        oce_input, parameters, initial_atm,
+                        models_kwargs[0]))
+                    oce_job = pool.apply_async(_jacobi_task, ("oce",
+                        atm_input, parameters, initial_oce,
+                        models_kwargs[1]))
+                    atm_state += [atm_job.get()]
+                    pbar.update(1)
+                    oce_state += [oce_job.get()]
+                else:
+                    atm_state += [compute_atmosphere(simulator_atm,
+                        oce_input, parameters, initial=initial_atm,
+                        **models_kwargs[0])]
+                    pbar.update(1)
+                    oce_state += [compute_ocean(simulator_oce,
+                        atm_state[-1], parameters, initial=initial_oce,
+                        **models_kwargs[1])]
+                pbar.update(1)
+                if relaxation is not None:
+                    memory = relax(relaxation, memory,
+                            _interface_vector(oce_state[-1]))
+                if cache_iterations:
+                    memoisation.store((atm_state[-1], oce_state[-1]) +
+                            ((memory,) if relaxation is not None else ()),
+                            schwarz_coupling, *key, iteration=iteration,
+                            compute_duration=time.time() - start)
+            oce_input = oce_state[-1] if relaxation is None else \
+                    _from_interface_vector(memory["inputs"][-1],
+                            oce_state[-1])
+            _retain(atm_state, keep_full)
+            _retain(oce_state, keep_full, first=1)
+            if len(atm_state) > 1:
+                history += [interface_change(atm_state[-1],
+                    atm_state[-2], norm)]
+            if checkpoints is not None:
+                checkpoints.save(iteration, {"iteration": iteration,
+                    "atm": atm_state, "oce": oce_state,
+                    "memory": memory, "history": history})
+                checkpoints.child("iteration_" + str(iteration)).clear()
+            if tolerance is not None and history and \
+                    history[-1] < tolerance:
+                break
+    if checkpoints is not None:
+        checkpoints.clear()
+        checkpoints.flush()
+    if tolerance is not None:
+        return atm_state, oce_state, history
+    return atm_state, oce_state
+
+def _retain(states: list, keep_full, first: int=0) -> None:
+    """
+        spills to the disk the "other" of the before-last state
+        of states if keep_full does not keep it.
+        states[first] is the state of the first iteration.
+    """
+    index = len(states) - 2
+    if index < first or keep_full == "all" or \
+            (keep_full != "last" and index - first in keep_full):
+        return
+    if type(states[index].other) is dict:
+        states[index] = states[index]._replace(
+                other=memoisation.SpilledDict(states[index].other))
+
+def interface_change(atm_state: StateAtm, previous: StateAtm,
+        norm=np.inf) -> float:
+    """
+        relative change of the interface series (u_delta, t_delta,
+        u_star, t_star) between two iterates of the atmosphere.
+        The largest relative change of the four series is returned.
+    """
+    return _relative_change((atm_state.u_delta, atm_state.t_delta,
+            atm_state.u_star, atm_state.t_star),
+            (previous.u_delta, previous.t_delta,
+            previous.u_star, previous.t_star), norm)
+
+def _relative_change(new_series: tuple, old_series: tuple,
+        norm=np.inf) -> float:
+    """
+        largest relative change between new_series[i]
+        and old_series[i]: each series is normalised separately.
+    """
+    changes = []
+    for new, old in zip(new_series, old_series):
+        reference = np.linalg.norm(old, ord=norm)
+        changes += [np.linalg.norm(new - old, ord=norm) /
+                (reference if reference > 0 else 1.)]
+    return max(changes)
+
+def _forked_pool(simulator_oce: Ocean1dStratified,
+        simulator_atm: Atm1dStratified, processes: int=2):
+    """
+        returns a pool of forked processes (for the Jacobi
+        iterations or the ensembles). The simulators are not sent
+        with each task: the workers inherit them from the
+        global _pool_simulators.
+    """
+    global _pool_simulators
+    _pool_simulators = (simulator_oce, simulator_atm)
+    return multiprocessing.get_context("fork").Pool(processes)
+
+def _jacobi_task(model: str, state, parameters: NumericalSetting,
+        initial: Dict, kwargs: Dict):
+    """ integrates model ("atm" or "oce") in a Jacobi worker """
+    simulator_oce, simulator_atm = _pool_simulators
+    if model == "atm":
+        ret = compute_atmosphere(simulator_atm, state, parameters,
+                initial=initial, **kwargs)
+    else:
+        ret = compute_ocean(simulator_oce, state, parameters,
+                initial=initial, **kwargs)
+    if kwargs.get("checkpoint") is not None:
+        kwargs["checkpoint"].flush() # before the parent deletes them
+    return ret
+
+def compare_jacobi(simulator_oce: Ocean1dStratified,
+        simulator_atm: Atm1dStratified,
+        parameters: NumericalSetting,
+        NUMBER_SCHWARZ_ITERATION: int=5, **kwargs) -> Dict:
+    """
+        runs the Gauss-Seidel and Jacobi couplings and returns
+        {mode: (wall-clock time, interface changes)} where the
+        interface changes are the ones of each iteration
+        (see interface_change). A table is also printed.
+    """
+    ret = {}
+    for mode in ("Gauss-Seidel", "Jacobi"):
+        start = time.time()
+        *_, history = schwarz_coupling(simulator_oce, simulator_atm,
+                parameters, NUMBER_SCHWARZ_ITERATION,
+                tolerance=0., jacobi=(mode == "Jacobi"), **kwargs)
+        ret[mode] = (time.time() - start, history)
+    print("iteration " + "".join(f"{mode:>14s}" for mode in ret))
+    for iteration in range(NUMBER_SCHWARZ_ITERATION - 1):
+        print(f"{iteration+1:9d} " + "".join(f"{ret[mode][1][iteration]:14.2e}"
+            if iteration < len(ret[mode][1]) else " "*14 for mode in ret))
+    print("time (s)  " + "".join(f"{ret[mode][0]:14.1f}" for mode in ret))
+    return ret
+
+def windowed_schwarz_coupling(simulator_oce: Ocean1dStratified,
+        simulator_atm: Atm1dStratified,
+        parameters: NumericalSetting,
+        window: float,
+        NUMBER_SCHWARZ_ITERATION: int=10,
+        tolerance: float=None,
+        **kwargs)-> (StateAtm, StateOce):
+    """
+        Schwarz waveform relaxation on successive windows of
+        length window (in seconds) covering [0, parameters.T]:
+        each window is coupled with schwarz_coupling (which
+        receives the other arguments) and starts from the last
+        time step of the previous window.
+        Only the last iterate of each window is kept: the returned
+        states contain the interface series of all the windows,
+        the last_tstep and other of the last window.
+        other["iterations"] is the number of iterations of
+        each window (and other["history"] their interface
+        changes if tolerance is given).
+    """
+    initial_state, first_guess = None, None
+    atm_windows, oce_windows = [], []
+    iterations, history = [], []
+    for setting in _windows(parameters, window,
+            (simulator_oce.dt, simulator_atm.dt)):
+        ret = schwarz_coupling(simulator_oce, simulator_atm, setting,
+                NUMBER_SCHWARZ_ITERATION=NUMBER_SCHWARZ_ITERATION,
+                tolerance=tolerance, initial_state=initial_state,
+                first_guess=first_guess, **kwargs)
+        atm_windows += [ret[0][-1]]
+        oce_windows += [ret[1][-1]]
+        _forget_other(atm_windows)
+        _forget_other(oce_windows)
+        iterations += [len(ret[0])]
+        if tolerance is not None:
+            history += [ret[2]]
+        initial_state = (ret[0][-1].last_tstep, ret[1][-1].last_tstep)
+        first_guess = _constant_guess(oce_windows[-1])
+
+    diagnostics = {"iterations": iterations}
+    if tolerance is not None:
+        diagnostics["history"] = history
+    return _concatenate_windows(atm_windows, oce_windows, diagnostics)
+
+def pipelined_schwarz_coupling(simulator_oce: Ocean1dStratified,
+        simulator_atm: Atm1dStratified,
+        parameters: NumericalSetting,
+        window: float,
+        NUMBER_SCHWARZ_ITERATION: int=10,
+        tolerance: float=None, norm=np.inf,
+        prediction_tolerance: float=1e-3,
+        **kwargs)-> (StateAtm, StateOce):
+    """
+        Same coupling as windowed_schwarz_coupling, but the
+        windows are pipelined on two processes: once the
+        atmosphere of a window has converged (or done its
+        NUMBER_SCHWARZ_ITERATION iterations), the first
+        atmosphere iteration of the next window starts while
+        the last ocean integration of the window is running.
+        This speculative atmosphere uses the ocean interface of
+        the previous ocean iterate (a constant, see
+        _constant_guess). If it differs from the ocean interface
+        of the last iterate by more than prediction_tolerance
+        (relative change of u_delta or of t_delta in the norm
+        given by norm), the speculative atmosphere is discarded
+        and computed again.
+        other["speculations"] tells for each window after the
+        first one if the speculative atmosphere was kept.
+    """
+    initial_state, first_guess = (None, None), None
+    atm_windows, oce_windows = [], []
+    iterations, history, speculations = [], [], []
+    speculative = None # (guess, job) of the next window
+    settings = list(_windows(parameters, window,
+        (simulator_oce.dt, simulator_atm.dt)))
+    # the workers are terminated when leaving the block
+    # (even after an exception)
+    with _forked_pool(simulator_oce, simulator_atm) as pool:
+        for number, setting in enumerate(settings):
+            oce_state = [initialization_ocean(setting, simulator_oce)
+                    if first_guess is None else first_guess]
+            atm_state, changes = [], []
+            if speculative is not None:
+                guess, job = speculative
+                prediction = _relative_change((guess.u_delta,
+                    guess.t_delta), (first_guess.u_delta,
+                        first_guess.t_delta), norm)
+                speculations += [bool(prediction < prediction_tolerance)]
+                if speculations[-1]:
+                    atm_state, oce_state = [job.get()], [guess]
+                else: # correction: the first iteration is done again
+                    job.wait()
+                speculative = None
+            for iteration in range(NUMBER_SCHWARZ_ITERATION):
+                if iteration >= len(atm_state):
+                    atm_state += [pool.apply_async(_jacobi_task, ("atm",
+                        oce_state[-1], setting, initial_state[0],
+                        kwargs)).get()]
+                if len(atm_state) > 1:
+                    changes += [interface_change(atm_state[-1],
+                        atm_state[-2], norm)]
+                last = iteration == NUMBER_SCHWARZ_ITERATION - 1 or \
+                        (tolerance is not None and len(changes) > 0
+                                and changes[-1] < tolerance)
+                oce_job = pool.apply_async(_jacobi_task, ("oce",
+                    atm_state[-1], setting, initial_state[1], kwargs))
+                if last and number + 1 < len(settings):
+                    # the next window starts with the ocean predicted
+                    # from the previous ocean iterate:
+                    guess = _constant_guess(oce_state[-1])
+                    speculative = (guess, pool.apply_async(_jacobi_task,
+                        ("atm", guess, settings[number+1],
+                            atm_state[-1].last_tstep, kwargs)))
+                oce_state += [oce_job.get()]
+                if last:
+                    break
+            atm_windows += [atm_state[-1]]
+            oce_windows += [oce_state[-1]]
+            _forget_other(atm_windows)
+            _forget_other(oce_windows)
+            iterations += [len(atm_state)]
+            history += [changes]
+            initial_state = (atm_state[-1].last_tstep,
+                    oce_state[-1].last_tstep)
+            first_guess = _constant_guess(oce_state[-1])
+
+    diagnostics = {"iterations": iterations, "speculations": speculations}
+    if tolerance is not None:
+        diagnostics["history"] = history
+    return _concatenate_windows(atm_windows, oce_windows, diagnostics)
+
+def _windows(parameters: NumericalSetting, window: float,
+        time_steps: Tuple[float, float]):
+    """
+        yields the NumericalSetting of the successive windows
+        of length window covering [0, parameters.T].
+        time_steps are the dt of the models.
+    """
+    assert window > 0
+    t_start = 0.
+    while t_start < parameters.T - 1e-6:
+        length = min(window, parameters.T - t_start)
+        for dt in time_steps:
+            assert abs(length/dt - round(length/dt)) < 1e-6, \
+                    "windows should contain whole time steps"
+        yield parameters._replace(T=length,
+                t_start=parameters.t_start + t_start,
+                Q_sw=_window_series(parameters.Q_sw, parameters.T,
+                    t_start, length),
+                Q_lw=_window_series(parameters.Q_lw, parameters.T,
+                    t_start, length))
+        t_start += length
+
+def _constant_guess(oce_state: StateOce) -> StateOce:
+    """ ocean constant equal to the last value of oce_state """
+    return StateOce(u_delta=np.full(2, oce_state.u_delta[-1]),
+            t_delta=np.full(2, oce_state.t_delta[-1]),
+            last_tstep=None, other=None)
+
+def _forget_other(windows: list) -> None:
+    """
+        drops the "other" (trajectories,...) of the before-last
+        window: only the one of the last window is returned,
+        so the memory does not grow with the number of windows.
+    """
+    if len(windows) > 1:
+        windows[-2] = windows[-2]._replace(other={})
+
+def _concatenate_windows(atm_windows: List[StateAtm],
+        oce_windows: List[StateOce],
+        diagnostics: Dict) -> (StateAtm, StateOce):
+    """
+        states covering all the windows: the interface series
+        are concatenated, last_tstep and other are the ones of
+        the last window (diagnostics are added to other).
+    """
+    def series(states, name):
+        # the first value of a window is the last of the previous one
+        return np.concatenate([getattr(states[0], name)] +
+                [getattr(state, name)[1:] for state in states[1:]])
+    atm_state = StateAtm(u_delta=series(atm_windows, "u_delta"),
+            t_delta=series(atm_windows, "t_delta"),
+            u_star=np.concatenate([s.u_star for s in atm_windows]),
+            t_star=np.concatenate([s.t_star for s in atm_windows]),
+            last_tstep=atm_windows[-1].last_tstep,
+            other=dict(atm_windows[-1].other, **diagnostics))
+    oce_state = StateOce(u_delta=series(oce_windows, "u_delta"),
+            t_delta=series(oce_windows, "t_delta"),
+            last_tstep=oce_windows[-1].last_tstep,
+            other=dict(oce_windows[-1].other, **diagnostics))
     return atm_state, oce_state
 
+def _window_series(series: np.ndarray, T: float,
+        t_start: float, length: float) -> np.ndarray:
+    """
+        restriction to [t_start, t_start+length] of series,
+        which is sampled uniformly on [0, T].
+    """
+    series = np.asarray(series)
+    times = np.linspace(0, T, series.shape[0])
+    number = max(2, int(np.ceil(series.shape[0] * length / T)) + 1)
+    return np.interp(np.linspace(t_start, t_start + length, number),
+            times, series)
+
+def relax(relaxation: Relaxation, memory: Dict,
+        output: np.ndarray) -> Dict:
+    """
+        one step of the relaxation of the fixed point x = G(x).
+        output is G(x) where x is memory["inputs"][-1].
+        memory contains the "inputs" x, the residuals G(x) - x
+        and the current "omega"; it is empty at the first call
+        (the first output is then used as it is).
+        returns the new memory: the next input to give to G
+        is its "inputs"[-1].
+    """
+    if not memory:
+        return {"inputs": [output], "residuals": [],
+                "omega": relaxation.omega}
+    inputs = memory["inputs"]
+    residuals = memory["residuals"] + [output - inputs[-1]]
+    omega = memory["omega"]
+    if relaxation.method == "fixed":
+        next_input = inputs[-1] + omega * residuals[-1]
+    elif relaxation.method == "aitken":
+        if len(residuals) > 1:
+            d_residual = residuals[-1] - residuals[-2]
+            if np.dot(d_residual, d_residual) > 0:
+                omega = -omega * np.dot(residuals[-2], d_residual) / \
+                        np.dot(d_residual, d_residual)
+        next_input = inputs[-1] + omega * residuals[-1]
+    elif relaxation.method == "anderson":
+        next_input = inputs[-1] + omega * residuals[-1]
+        if len(residuals) > 1:
+            d_inputs = np.diff(np.array(inputs), axis=0).T
+            d_residuals = np.diff(np.array(residuals), axis=0).T
+            gamma = np.linalg.lstsq(d_residuals, residuals[-1],
+                    rcond=None)[0]
+            next_input -= (d_inputs + omega * d_residuals) @ gamma
+    else:
+        raise NotImplementedError("Unknown relaxation " +
+                relaxation.method)
+    # only the last iterates are needed:
+    depth = relaxation.depth + 1 if relaxation.method == "anderson" else 2
+    return {"inputs": (inputs + [next_input])[-depth:],
+            "residuals": residuals[-depth+1:],
+            "omega": omega}
+
+def _interface_vector(oce_state: StateOce) -> np.ndarray:
+    """ real vector of the ocean data used by the atmosphere """
+    return np.concatenate((np.real(oce_state.u_delta),
+        np.imag(oce_state.u_delta), np.real(oce_state.t_delta)))
+
+def _from_interface_vector(vector: np.ndarray,
+        oce_state: StateOce) -> StateOce:
+    """ inverse of _interface_vector (oce_state gives the sizes) """
+    N_u, N_t = oce_state.u_delta.shape[0], oce_state.t_delta.shape[0]
+    return oce_state._replace(
+            u_delta=vector[:N_u] + 1j*vector[N_u:2*N_u],
+            t_delta=vector[2*N_u:2*N_u+N_t])
+
+def _iteration_key(simulator_oce: Ocean1dStratified,
+        simulator_atm: Atm1dStratified,
+        parameters: NumericalSetting, kwargs: Dict) -> tuple:
+    """
+        arguments identifying the setting of a coupling, used
+        to store the iterations of schwarz_coupling.
+        The simulators are described by their class (its source
+        is then part of the fingerprint) and their parameters.
+    """
+    def attributes(simulator):
+        # the *_copy attributes are diagnostics of the last integration
+        return {name: value for name, value in vars(simulator).items()
+                if isinstance(value, (numbers.Number, str, np.ndarray))
+                and not name.endswith("_copy")}
+    return (type(simulator_oce), attributes(simulator_oce),
+            type(simulator_atm), attributes(simulator_atm),
+            parameters, kwargs)
+
+def initialization_atmosphere(numer_set: NumericalSetting,
+        simulator_atm: Atm1dStratified,
+        oce_state: StateOce) -> StateAtm:
+    """
+    returns a State that can be used by ocean model for integration:
+    the atmosphere is at rest in the geostrophic wind and the
+    friction scales are the ones of the initial ocean oce_state.
+    """
+    N = int(numer_set.T/simulator_atm.dt) # Number of time steps
+    u_delta = simulator_atm.u_g + 0j
+    SL = friction_scales(u_delta, numer_set.delta_sl_a, INIT_THETA_ATM,
+            businger, oce_state.u_delta[0], numer_set.delta_sl_o,
+            oce_state.t_delta[0], large_ocean, numer_set.sf_scheme_a,
+            np.asarray(numer_set.Q_sw)[0], np.asarray(numer_set.Q_lw)[0],
+            0)
+    return StateAtm(u_delta=np.ones(N+1) * u_delta,
+            t_delta=np.ones(N+1) * INIT_THETA_ATM,
+            u_star=np.ones(N) * SL.u_star,
+            t_star=np.ones(N) * SL.t_star,
+            last_tstep=None, other=None)
+
 def initialization_ocean(numer_set: NumericalSetting,
         simulator_oce: Ocean1dStratified) -> StateOce:
     """
     returns a State that can be used by ocean model for integration.
     """
     N = int(numer_set.T/simulator_oce.dt) # Number of time steps
-    days = np.linspace(0, numer_set.T/86400. , N)
+    days = np.linspace(numer_set.t_start/86400.,
+            (numer_set.t_start + numer_set.T)/86400., N)
     # t_delta = INIT_THETA_OCE + np.zeros(N)
     t_delta = INIT_THETA_OCE + np.cos(2*np.pi*(days-0.26))
     # diurnal activity
@@ -87,11 +660,58 @@ def initialization_ocean(numer_set: NumericalSetting,
             t_delta=t_delta,
             last_tstep=None, other=None)
 
+def parallel_ensemble_coupling(simulator_oce: Ocean1dStratified,
+        simulator_atm: Atm1dStratified,
+        ensemble: List[NumericalSetting],
+        NUMBER_SCHWARZ_ITERATION: int=1,
+        processes: int=None, **kwargs) -> list:
+    """
+        runs schwarz_coupling for each member of ensemble
+        (the members share the grids of the simulators and differ
+        by their forcings, surface flux schemes, delta_sl,...).
+        The members are independent couplings integrated in a pool
+        of processes (default: one per CPU, at most one per member).
+        This is not a batched integration: the models have no
+        member axis, so the throughput is bounded by the number
+        of cores and not by the size of the ensemble.
+        Returns the results of schwarz_coupling (in the order of
+        ensemble) and prints the throughput in members per second.
+        The workers are daemonic: jacobi cannot be used.
+    """
+    assert not kwargs.get("jacobi", False)
+    processes = min(len(ensemble), processes or os.cpu_count() or 1)
+    start = time.time()
+    if processes <= 1:
+        ret = [schwarz_coupling(simulator_oce, simulator_atm, member,
+            NUMBER_SCHWARZ_ITERATION, **kwargs) for member in ensemble]
+    else:
+        # the results are sent back whole to this process:
+        # spilling the iterates in the workers would be useless.
+        kwargs = dict(kwargs, keep_full="all")
+        with _forked_pool(simulator_oce, simulator_atm,
+                processes) as pool:
+            ret = pool.starmap(_ensemble_task, [(member,
+                NUMBER_SCHWARZ_ITERATION, kwargs) for member in ensemble],
+                chunksize=1)
+    print(f"{len(ensemble)} members on {processes} processes: "
+            f"{len(ensemble)/(time.time() - start):.3g} members/s")
+    return ret
+
+def _ensemble_task(parameters: NumericalSetting,
+        NUMBER_SCHWARZ_ITERATION: int, kwargs: Dict):
+    """ couples one member of an ensemble in a worker """
+    simulator_oce, simulator_atm = _pool_simulators
+    return schwarz_coupling(simulator_oce, simulator_atm, parameters,
+            NUMBER_SCHWARZ_ITERATION, **kwargs)
+
 def compute_ocean(simulator_oce: Ocean1dStratified,
         atm_state: StateAtm,
-        numer_set: NumericalSetting, **kwargs) -> StateOce:
+        numer_set: NumericalSetting, initial: Dict=None,
+        **kwargs) -> StateOce:
     """
-        Integrator in time of the ocean
+        Integrator in time of the ocean.
+        initial is the last_tstep of a previous integration
+        to start from (default: initialization of the ocean).
     """
     T0 = INIT_THETA_OCE # Reference temperature
     N = int(numer_set.T/simulator_oce.dt) # Number of time steps
@@ -103,17 +723,22 @@ def compute_ocean(simulator_oce: Ocean1dStratified,
     dz_theta_0 = np.ones(simulator_oce.M+1) * simulator_oce.N0**2 \
             / simulator_oce.alpha / 9.81
 
-    Q_sw = projection(np.asarray(numer_set.Q_sw), N)
-    Q_lw = projection(np.asarray(numer_set.Q_lw), N)
+    Q_sw, Q_lw, wind_10m, temp_10m, u_star, t_star = projections(N,
+            numer_set.Q_sw, numer_set.Q_lw, atm_state.u_delta,
+            atm_state.t_delta, atm_state.u_star, atm_state.t_star)
     delta_sl_o = numer_set.delta_sl_o
     delta_sl_a = numer_set.delta_sl_a
     sf_scheme = numer_set.sf_scheme_o
-    wind_10m = projection(atm_state.u_delta, N)
-    temp_10m = projection(atm_state.t_delta, N)
-    u_star = projection(atm_state.u_star, N)
-    t_star = projection(atm_state.t_star, N)
 
-    if sf_scheme in {"FV free", "FV2", "FV Zeng"}:
+    if initial is not None:
+        u_0, theta_0 = initial["u"], initial["theta"]
+        kwargs["restart"] = initial["restart"]
+    if initial is not None and sf_scheme[:2] == "FV":
+        u_i, phi_i, theta_i, dz_theta_i, u_delta, t_delta = \
+                initial["u"], initial["phi"], initial["theta"], \
+                initial["dz_theta"], initial["u_delta"], \
+                initial["t_delta"]
+    elif sf_scheme in {"FV free", "FV2", "FV Zeng"}:
         u_i, phi_i, theta_i, dz_theta_i, u_delta, t_delta = \
                 simulator_oce.initialization(\
                 np.zeros(simulator_oce.M)+0j, # u_0
@@ -147,11 +772,14 @@ def compute_ocean(simulator_oce: Ocean1dStratified,
     else:
         raise NotImplementedError("Cannot infer discretization " + \
                 "from surface flux scheme name " + sf_scheme)
-    last_tstep = {key: ret[key] for key in ("u", "theta", "tke")}
+    last_tstep = {key: ret[key] for key in ("u", "theta", "tke",
+        "restart")}
 
     if sf_scheme[:2] == "FV":
         last_tstep["dz_theta"] = ret["dz_theta"]
         last_tstep["phi"] = ret["phi"]
+        last_tstep["u_delta"] = ret["u_delta"][-1]
+        last_tstep["t_delta"] = ret["t_delta"][-1]
 
     return StateOce(u_delta=np.array(ret["u_delta"]),
             t_delta=np.array(ret["t_delta"]),
@@ -159,9 +787,17 @@ def compute_ocean(simulator_oce: Ocean1dStratified,
 
 def compute_atmosphere(simulator_atm: Atm1dStratified,
         oce_state: StateOce,
-        numer_set: NumericalSetting, **kwargs) -> StateAtm:
+        numer_set: NumericalSetting, initial: Dict=None,
+        warm_start: Tuple=None, init_tolerance: float=None,
+        **kwargs) -> StateAtm:
     """
-        Integrator in time of the atmosphere
+        Integrator in time of the atmosphere.
+        initial is the last_tstep of a previous integration
+        to start from (default: initialization of the atmosphere).
+        warm_start is other["initialization"] of a previous
+        atmosphere state, used as the starting point of the FV free
+        initialization, which then stops at the relative accuracy
+        init_tolerance (or after INIT_MAX_ITER passes).
     """
     u_G = simulator_atm.u_g
     N = int(numer_set.T/simulator_atm.dt) # Number of time steps
@@ -172,25 +808,36 @@ def compute_atmosphere(simulator_atm: Atm1dStratified,
     dz_theta_0 = np.zeros(M+1)
     forcing = 1j*simulator_atm.f*simulator_atm.u_g*np.ones((N+1, M))
     forcing_theta = 1.2e-6*np.ones((N+1, M)) # ~ 1 K/day
-    days = np.linspace(0, numer_set.T/86400. , N+1)
+    days = np.linspace(numer_set.t_start/86400.,
+            (numer_set.t_start + numer_set.T)/86400., N+1)
     forcing_theta = np.outer(\
             np.maximum(np.cos(2*np.pi*(days-0.26)), 0.),
             1.2e-6*np.ones(M) * np.pi)
 
     delta_sl = numer_set.delta_sl_a
     sf_scheme = numer_set.sf_scheme_a
-    uo_delta = projection(oce_state.u_delta, N)
-    to_delta = projection(oce_state.t_delta, N)
-    Q_sw = projection(np.asarray(numer_set.Q_sw), N)
-    Q_lw = projection(np.asarray(numer_set.Q_lw), N)
+    uo_delta, to_delta, Q_sw, Q_lw = projections(N, oce_state.u_delta,
+            oce_state.t_delta, numer_set.Q_sw, numer_set.Q_lw)
     z_constant = 15
 
-    if sf_scheme in {"FV free", "FV2"}:
+    if initial is not None:
+        u_0, theta_0 = initial["u"], initial["theta"]
+        kwargs["restart"] = initial["restart"]
+    if initial is not None and sf_scheme[:2] == "FV":
+        u_i, phi_i, theta_i, dz_theta_i, u_delta, t_delta = \
+                initial["u"], initial["phi"], initial["theta"], \
+                initial["dz_theta"], initial["u_delta"], \
+                initial["t_delta"]
+    elif sf_scheme in {"FV free", "FV2"}:
         u_i, phi_i, theta_i, dz_theta_i, u_delta, t_delta = \
                 simulator_atm.initialization(\
                 u_0, phi_0, theta_0, dz_theta_0, delta_sl,
                 uo_delta[0], to_delta[0], Q_sw[0], Q_lw[0],
-                z_constant, numer_set.delta_sl_o, u_G)
+                z_constant, numer_set.delta_sl_o, u_G,
+                warm_start=warm_start, tolerance=init_tolerance,
+                max_iter=INIT_MAX_ITER)
+        initialization = (np.copy(u_i), np.copy(phi_i),
+                np.copy(theta_i), np.copy(dz_theta_i), u_delta, t_delta)
     else:
         u_i, phi_i, theta_i, dz_theta_i, u_delta, t_delta = \
                 u_0, phi_0, theta_0, dz_theta_0, u_0[0], theta_0[0]
@@ -216,11 +863,16 @@ def compute_atmosphere(simulator_atm: Atm1dStratified,
     else:
         raise NotImplementedError("Cannot infer discretization " + \
                 "from surface flux scheme name " + sf_scheme)
-    last_tstep = {key: ret[key] for key in ("u", "theta", "tke")}
+    last_tstep = {key: ret[key] for key in ("u", "theta", "tke",
+        "restart")}
 
     if sf_scheme[:2] == "FV":
         last_tstep["dz_theta"] = ret["dz_theta"]
         last_tstep["phi"] = ret["phi"]
+        last_tstep["u_delta"] = ret["u_delta"][-1]
+        last_tstep["t_delta"] = ret["t_delta"][-1]
+    if initial is None and sf_scheme in {"FV free", "FV2"}:
+        ret["initialization"] = initialization
     return StateAtm(u_delta=np.array(ret["u_delta"]),
             t_delta=np.array(ret["t_delta"]),
             u_star=np.array(ret["all_u_star"]),
@@ -231,7 +883,45 @@ def compute_atmosphere(simulator_atm: Atm1dStratified,
 def projection(array: np.ndarray, N: int)-> np.ndarray:
     """
         projects an array of size array.shape[0] onto
-        an other array of shape N+1.
+        an other array of shape N+1 (linear interpolation).
+        Several series can be projected at once by
+        stacking them along the other axes.
+    """
+    array = np.asarray(array)
+    index, weight = _interpolation_operator(array.shape[0], N)
+    weight = weight.reshape((-1,) + (1,) * (array.ndim - 1))
+    return array[index] + weight * (array[index+1] - array[index])
+
+def projections(N: int, *arrays: np.ndarray) -> List[np.ndarray]:
+    """
+        [projection(array, N) for array in arrays], but the
+        arrays of same size are projected together.
+    """
+    ret = [None] * len(arrays)
+    arrays = [np.asarray(array) for array in arrays]
+    for size in {array.shape[0] for array in arrays}:
+        same_size = [i for i, array in enumerate(arrays)
+                if array.shape[0] == size]
+        projected = projection(np.stack([arrays[i] for i in same_size],
+            axis=-1), N)
+        for column, i in enumerate(same_size):
+            ret[i] = projected[..., column] \
+                    if np.iscomplexobj(arrays[i]) \
+                    else np.real(projected[..., column])
+    return ret
+
+@functools.lru_cache(maxsize=64)
+def _interpolation_operator(n_in: int, N: int) -> (np.ndarray, np.ndarray):
+    """
+        linear interpolation from np.linspace(0, 1, n_in) to
+        np.linspace(0, 1, N+1): the value at the point i is
+        (1-weight[i]) * array[index[i]] + weight[i] * array[index[i]+1].
     """
-    return interpolate.interp1d(np.linspace(0, 1, array.shape[0]),
-            array)(np.linspace(0, 1, N+1))
+    assert n_in > 1
+    position = np.linspace(0, 1, N+1) * (n_in - 1)
+    index = np.minimum(np.floor(position).astype(int), n_in - 2)
+    weight = position - index
+    # the arrays are shared by all the calls:
+    index.setflags(write=False)
+    weight.setflags(write=False)
+    return index, weight
@@ -0,0 +1,178 @@
+"""
+    Non-regression tests, launched by "./main.py test".
+    Each test_* function raises an AssertionError if it fails.
+    The tests which use the cache run in a temporary folder.
+"""
+import os
+import tempfile
+import unittest.mock
+from typing import NamedTuple
+import numpy as np
+import memoisation
+import utils_linalg
+import schwarz_coupler
+from schwarz_coupler import NumericalSetting
+from atm1DStratified import Atm1dStratified
+from ocean1DStratified import Ocean1dStratified
+
+def launch_all_tests():
+    """ runs all the test_* functions of this module """
+    tests = [value for name, value in sorted(globals().items())
+            if name.startswith("test_") and callable(value)]
+    directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            for test in tests:
+                print("Running " + test.__name__ + "...")
+                test()
+        finally:
+            os.chdir(directory)
+    print("All the " + str(len(tests)) + " tests passed.")
+
+def coupling_setting(T: float=3*3600., sf_scheme_a: str="FV free",
+        sf_scheme_o: str="FV free"):
+    """
+        returns (simulator_oce, simulator_atm, NumericalSetting)
+        of a short coupling with the grids of
+        figures.simulation_coupling.
+    """
+    time = np.linspace(0, T)
+    Qswmax = 500.
+    Qlw = -np.ones_like(time) * Qswmax / np.pi
+    Qsw = np.maximum(np.cos(2.*np.pi*(time/86400. - 0.26)), 0. ) * Qswmax
+    z_levels_oce = np.concatenate((-np.linspace(30,1,30)**1.5-50,
+        np.linspace(-50., 0., 51)))
+    z_levels_atm = np.concatenate((np.linspace(0.,500, 51),
+        10*np.linspace(1,15,15)**1.5+500))
+    simulator_oce = Ocean1dStratified(z_levels=z_levels_oce,
+            dt=90., u_geostrophy=0., f=1e-4, alpha=0.0002, N0=0.01)
+    simulator_atm = Atm1dStratified(z_levels=z_levels_atm,
+            dt=30., u_geostrophy=8., K_mol=simulator_oce.K_mol/6.7e-2,
+            f=1e-4)
+    delta_sl_o = z_levels_oce[-2] if sf_scheme_o == "FV free" else 0.
+    setting = NumericalSetting(T=T, sf_scheme_a=sf_scheme_a,
+            sf_scheme_o=sf_scheme_o, delta_sl_a=z_levels_atm[1]/2.,
+            delta_sl_o=delta_sl_o, Q_lw=Qlw, Q_sw=Qsw)
+    return simulator_oce, simulator_atm, setting
+
+class Pair(tuple):
+    """ tuple subclass (not a NamedTuple) """
+
+class Series(list):
+    """ list subclass """
+
+class Point(NamedTuple):
+    """ NamedTuple """
+    x: np.ndarray
+    name: str
+
+def test_payload_round_trip():
+    """ save_payload then load_payload rebuilds the same object """
+    res = {"pair": Pair((np.arange(3.), 1)),
+            "series": Series([np.ones(2), np.zeros(2)]),
+            "point": Point(x=np.arange(4), name="p"),
+            "nested": (Series([Pair((None, "a"))]), [np.eye(2)] * 2)}
+    memoisation.save_payload("payload", res)
+    loaded = memoisation.load_payload("payload")
+    assert type(loaded["pair"]) is Pair
+    assert type(loaded["series"]) is Series
+    assert type(loaded["point"]) is Point
+    assert type(loaded["nested"][0]) is Series
+    assert type(loaded["nested"][0][0]) is Pair
+    assert memoisation.stable_key(loaded) == memoisation.stable_key(res)
+
+def double(x):
+    """ memoised by test_memory_cache """
+    return {"x": np.full(3, 2. * x), "scalars": [x, 2. * x]}
+
+def test_memory_cache():
+    """
+        the in-memory cache is bounded, can be disabled and its
+        results cannot be modified by the callers.
+    """
+    with unittest.mock.patch.object(memoisation, "_memory_cache",
+            memoisation._MemoryCache()) as cache:
+        for x in range(memoisation.MEMORY_CACHE_MAX_ENTRIES + 10):
+            memoisation.memoised(double, x)
+        assert len(cache.results) == memoisation.MEMORY_CACHE_MAX_ENTRIES
+        res = memoisation.memoised(double, 1.)
+        res["scalars"].append(None)
+        try:
+            res["x"][0] = 0.
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("a cached array is writable")
+        res = memoisation.memoised(double, 1.)
+        assert res["scalars"] == [1., 2.] and res["x"][0] == 2.
+    with unittest.mock.patch.dict(os.environ,
+            MEMOISATION_MEMORY_SIZE="0"), unittest.mock.patch.object(
+                    memoisation, "_memory_cache",
+                    memoisation._MemoryCache()) as cache:
+        memoisation.memoised(double, 1.)
+        memoisation.memoised(double, 1.)
+        assert not cache.results and not cache.stats
+
+def test_shared_leaves():
+    """
+        the equal arrays of two results are stored once and
+        the eviction of one result does not modify the other.
+    """
+    memoisation.evict("double")
+    arrays = tuple(np.arange(1000.) * i for i in range(1, 5))
+    memoisation.store(arrays, double, "first")
+    memoisation.store((arrays[1:], "second"), double, "second")
+    assert len(os.listdir(memoisation.LEAVES_FOLDER_NAME)) == 4
+    memoisation.prune(0., keep=("double",
+        memoisation.stable_key(("second", ()))))
+    assert memoisation.lookup(double, "first") is None
+    assert len(os.listdir(memoisation.LEAVES_FOLDER_NAME)) == 3
+    res = memoisation.lookup(double, "second")
+    assert res[1] == "second" and all(np.array_equal(stored, array)
+            for stored, array in zip(res[0], arrays[1:]))
+    memoisation.evict("double")
+    assert not os.listdir(memoisation.LEAVES_FOLDER_NAME)
+
+def test_warm_start_convergence():
+    """
+        the warm-started initializations of the atmosphere
+        do not slow down the convergence of the Schwarz iterations.
+    """
+    simulator_oce, simulator_atm, setting = coupling_setting()
+    *_, warm = schwarz_coupler.schwarz_coupling(simulator_oce,
+            simulator_atm, setting, NUMBER_SCHWARZ_ITERATION=6,
+            tolerance=0.)
+    compute_atmosphere = schwarz_coupler.compute_atmosphere
+    def cold_start(*args, warm_start=None, init_tolerance=None,
+            **kwargs):
+        return compute_atmosphere(*args, **kwargs)
+    with unittest.mock.patch.object(schwarz_coupler,
+            "compute_atmosphere", cold_start):
+        *_, cold = schwarz_coupler.schwarz_coupling(simulator_oce,
+                simulator_atm, setting, NUMBER_SCHWARZ_ITERATION=6,
+                tolerance=0.)
+    assert len(warm) == len(cold) == 5
+    for change_warm, change_cold in zip(warm, cold):
+        assert change_warm < 10 * change_cold, (warm, cold)
+
+def test_fingerprint_ignores_configuration():
+    """
+        the configuration of the cache and the debugging checks
+        do not change the fingerprints, the constants used do.
+    """
+    import figures
+    def fingerprint():
+        memoisation._fingerprints.clear()
+        return memoisation.source_fingerprint(figures.simulation_coupling)
+    reference = fingerprint()
+    with unittest.mock.patch.object(memoisation, "MAX_CACHE_SIZE", 1e6):
+        assert fingerprint() == reference
+    with unittest.mock.patch.object(utils_linalg, "CHECK_FINITE", True):
+        assert fingerprint() == reference
+    with unittest.mock.patch.object(schwarz_coupler, "INIT_MAX_ITER", 16):
+        assert fingerprint() != reference
+    assert fingerprint() == reference
+
+if __name__ == "__main__":
+    launch_all_tests()
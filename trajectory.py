@@ -0,0 +1,182 @@
+"""
+    This module defines the class Trajectory which stores
+    the profiles of all the time steps (store_all=True)
+    of the simulators in compressed chunks.
+"""
+import zlib
+import numpy as np
+
+array = np.ndarray
+
+class Trajectory():
+    """
+        List of the profiles (one array per time step) stored by
+        chunks of chunk_size frames compressed with zlib.
+        It is used like the list it replaces (len, indexing,
+        iteration, np.array(trajectory)); window() reads a window
+        in time and in space decompressing only the needed chunks.
+        When it is memoised, the compressed chunks are stored as
+        one array that is memory-mapped at loading.
+    """
+    MEMOISATION_SPLIT = True # see memoisation.save_payload
+
+    def __init__(self, chunk_size: int=256, level: int=1):
+        """
+            chunk_size: number of frames compressed together
+            level: zlib compression level (1 is the fastest)
+        """
+        self.chunk_size: int = chunk_size
+        self.level: int = level
+        self.chunks = [] # compressed chunks (arrays of bytes)
+        self.meta = [] # (number of frames, shape, dtype) of chunks
+        self.starts = [0] # index of the first frame of each chunk
+        self.buffer = [] # last frames, not compressed yet
+        self.replaced = {} # frames modified with __setitem__
+        self.__last_chunk = (None, None) # last decompressed chunk
+
+    def append(self, frame: array) -> None:
+        """ adds a copy of frame at the end of the trajectory """
+        frame = np.array(frame)
+        if self.buffer and (frame.shape != self.buffer[0].shape or
+                frame.dtype != self.buffer[0].dtype):
+            self.__flush()
+        self.buffer.append(frame)
+        if len(self.buffer) >= self.chunk_size:
+            self.__flush()
+
+    def copy(self) -> "Trajectory":
+        """
+            copy which is not modified by self.append: the
+            compressed chunks and the frames are shared since
+            they are never modified.
+        """
+        ret = Trajectory(self.chunk_size, self.level)
+        ret.chunks, ret.meta = list(self.chunks), list(self.meta)
+        ret.starts, ret.buffer = list(self.starts), list(self.buffer)
+        ret.replaced = dict(self.replaced)
+        return ret
+
+    def window(self, time=slice(None), depth=slice(None)) -> array:
+        """
+            returns the array of shape (time steps, space)
+            np.array(self)[time][:, depth] without decompressing
+            the chunks outside the time window.
+            time can be a slice, depth a slice or an index.
+        """
+        indices = range(*time.indices(len(self)))
+        if any(index in self.replaced for index in indices):
+            return np.array([self[index][depth] for index in indices])
+        parts = []
+        chunk, local = None, []
+        for index in indices:
+            index_chunk = self.__chunk_of(index)
+            if index_chunk != chunk and local:
+                parts.append(self.__frames(chunk)[local][:, depth])
+                local = []
+            chunk = index_chunk
+            local.append(index - self.__start(chunk))
+        if local:
+            parts.append(self.__frames(chunk)[local][:, depth])
+        if not parts:
+            return np.zeros((0,))
+        return np.concatenate(parts)
+
+    def __len__(self) -> int:
+        return self.starts[-1] + len(self.buffer)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Trajectory index out of range")
+        if index in self.replaced:
+            return self.replaced[index]
+        chunk = self.__chunk_of(index)
+        if chunk == len(self.chunks):
+            return self.buffer[index - self.__start(chunk)].copy()
+        return self.__frames(chunk)[index - self.__start(chunk)].copy()
+
+    def __setitem__(self, index: int, frame: array) -> None:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Trajectory index out of range")
+        self.replaced[index] = np.asarray(frame)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __array__(self, dtype=None, copy=None):
+        ret = self.window()
+        return ret if dtype is None else ret.astype(dtype)
+
+    def __getstate__(self) -> dict:
+        """ the compressed chunks are concatenated in one array """
+        lengths = [chunk.shape[0] for chunk in self.chunks]
+        return {"chunk_size": self.chunk_size, "level": self.level,
+                "blob": np.concatenate(self.chunks) if self.chunks
+                    else np.zeros(0, dtype=np.uint8),
+                "offsets": np.cumsum([0] + lengths),
+                "meta": self.meta, "starts": self.starts,
+                "buffer": self.buffer, "replaced": self.replaced}
+
+    def __setstate__(self, state: dict) -> None:
+        self.chunk_size = state["chunk_size"]
+        self.level = state["level"]
+        offsets, blob = state["offsets"], state["blob"]
+        # slices of blob: a memory-mapped blob stays on the disk
+        self.chunks = [blob[offsets[i]:offsets[i+1]]
+                for i in range(len(offsets) - 1)]
+        self.meta = list(state["meta"])
+        self.starts = list(state["starts"])
+        self.buffer = list(state["buffer"])
+        self.replaced = dict(state["replaced"])
+        self.__last_chunk = (None, None)
+
+    def __flush(self) -> None:
+        """ compresses the frames of the buffer in a new chunk """
+        stacked = np.stack(self.buffer)
+        self.chunks.append(np.frombuffer(zlib.compress(
+            stacked.tobytes(), self.level), dtype=np.uint8))
+        self.meta.append((stacked.shape[0], stacked.shape[1:],
+            stacked.dtype.str))
+        self.starts.append(self.starts[-1] + stacked.shape[0])
+        self.buffer = []
+
+    def __chunk_of(self, index: int) -> int:
+        """
+            index of the chunk containing the frame index.
+            len(self.chunks) is the buffer.
+        """
+        if index >= self.starts[-1]:
+            return len(self.chunks)
+        return int(np.searchsorted(self.starts, index, side="right")) - 1
+
+    def __start(self, chunk: int) -> int:
+        """ index of the first frame of chunk """
+        return self.starts[chunk]
+
+    def __frames(self, chunk: int) -> array:
+        """ decompressed frames of chunk (or of the buffer) """
+        if chunk == len(self.chunks):
+            return np.stack(self.buffer)
+        if self.__last_chunk[0] != chunk:
+            number, shape, dtype = self.meta[chunk]
+            frames = np.frombuffer(zlib.decompress(
+                self.chunks[chunk].tobytes()), dtype=dtype)
+            self.__last_chunk = (chunk, frames.reshape((number,) +
+                tuple(shape)))
+        return self.__last_chunk[1]
+
+
+def window(frames, time=slice(None), depth=slice(None)) -> array:
+    """
+        np.array(frames)[time][:, depth], where frames is
+        a Trajectory or a list of arrays (old cached results).
+    """
+    if isinstance(frames, Trajectory):
+        return frames.window(time, depth)
+    return np.array(frames[time])[:, depth]
@@ -4,6 +4,18 @@
 """
 import numpy as np
 from scipy import interpolate
+from scipy.linalg import get_lapack_funcs, LinAlgError
+from numba import jit
+
+# debug mode: set to True to check that the inputs of
+# BandedMatrix.solve (hence solve_linear) are finite.
+CHECK_FINITE: bool = False
+# solver of the complex systems (see BandedMatrix.solve):
+# "complex" uses the complex LAPACK routines and "real blocks"
+# the equivalent real system. Chosen with benchmark_backends
+# ("./main.py benchmark"): "complex" is faster for M <= 512.
+BACKENDS = ("complex", "real blocks")
+COMPLEX_BACKEND: str = "complex"
 
 def scal_multiply(Y, s):
     """
@@ -65,31 +77,362 @@ def solve_linear(Y, f):
         (lower diagonal, diagonal, upper diagonal)
         there can be additional upper or lower diagonal
         the position of diagonal is diagnosed from the shape
-        of the numpy arrays
+        of the numpy arrays.
+        Y and f are not modified (only the temporary matrix built
+        from Y is overwritten by the solve).
+    """
+    return BandedMatrix.from_diagonals(Y).solve(f, overwrite=True)
+
+def bands(Y) -> (int, int):
+    """
+        returns the numbers (l, u) of lower and upper diagonals
+        of Y = (lower diagonals, diagonal, upper diagonals).
+        The main diagonal is diagnosed from the shapes.
     """
     k = 0
     for i in range(1, len(Y)):
         if Y[i].shape[0] > Y[i-1].shape[0]:
             k = i
-
     # k is the index of the main diag: it means that
     # there is k diagonals at the left of the main diag,
     # and len(Y)-k-1 diagonals at the right of it
+    return k, len(Y) - k - 1
 
-    Y_to_stack = [] # creating future scipy banded matrix
+class BandedMatrix():
+    """
+        Banded matrix of size M with l lower and u upper
+        diagonals, stored in a preallocated buffer with the layout
+        of LAPACK (and scipy.linalg.solve_banded):
+        data[u + i - j, j] = A[i, j].
+        The operations (set, add, scale) modify the buffer in
+        place and return self. The tuples of diagonals Y used in
+        this module can be given to them.
+        There is no row override: the surface flux schemes replace
+        the first entries of each diagonal of Y and D separately,
+        and the patched Y is also used by the right-hand side,
+        so they patch the tuples before the matrix is built
+        (see __apply_sf_scheme and __backward_euler of the models).
+        When the diagonals are the same as in the previous solve,
+        an LU factorisation is computed once and then reused.
+    """
+    def __init__(self, l: int, u: int, M: int, dtype=np.float64):
+        self.l: int = l
+        self.u: int = u
+        self.M: int = M
+        self.data: np.ndarray = np.zeros((l + u + 1, M), dtype=dtype)
+        self.__key: bytes = None # diagonals of the last solve
+        self.__lu: tuple = None # (dtype, factorisation of __key)
+        self.__blocks: "BandedMatrix" = None # see real_blocks
 
-    for i in range(len(Y)-1, k, -1): # adding upper diagonals
-        Y_to_stack += [np.concatenate(([0] * (i-k), Y[i]))]
-    
-    Y_to_stack += [Y[k]] # adding diagonal to the stackable array
+    @classmethod
+    def from_diagonals(cls, Y, shape_bands=None, dtype=None,
+            out: "BandedMatrix"=None) -> "BandedMatrix":
+        """
+            returns the BandedMatrix of Y. shape_bands=(l, u) can be
+            larger than bands(Y). out is reused if it has the same
+            bands, size and dtype (it is then overwritten).
+        """
+        l, u = bands(Y)
+        M = Y[l].shape[0]
+        if shape_bands is not None:
+            l, u = shape_bands
+        dtype = np.result_type(*Y) if dtype is None else dtype
+        if out is None or (out.l, out.u, out.M, out.data.dtype) != \
+                (l, u, M, dtype):
+            out = cls(l, u, M, dtype)
+        return out.set(Y)
 
-    for i in range(k-1, -1, -1): # adding subdiagonals
-        Y_to_stack += [np.concatenate((Y[i], [0] * (k-i)))]
+    def diagonal(self, offset: int) -> np.ndarray:
+        """ view of the diagonal offset (>0 for upper diagonals) """
+        if offset >= 0:
+            return self.data[self.u - offset, offset:]
+        return self.data[self.u - offset, :self.M + offset]
 
-    Y = np.vstack(Y_to_stack)
+    def set(self, Y, factor=1.) -> "BandedMatrix":
+        """ self = factor * Y """
+        self.data[:] = 0.
+        return self.add(Y, factor)
 
-    from scipy.linalg import solve_banded
-    return solve_banded((k, len(Y) - k - 1), Y, f)
+    def add(self, Y, factor=1.) -> "BandedMatrix":
+        """ self += factor * Y (Y must fit in the bands of self) """
+        l, u = bands(Y)
+        assert l <= self.l and u <= self.u
+        for i, y in enumerate(Y):
+            self.diagonal(i - l)[:] += y * factor
+        return self
+
+    def scale(self, s) -> "BandedMatrix":
+        """ self *= s """
+        self.data *= s
+        return self
+
+    def real_blocks(self, out: "BandedMatrix"=None) -> "BandedMatrix":
+        """
+            real BandedMatrix of size 2M equivalent to self:
+            the unknowns are interleaved (real, imaginary parts)
+            and each entry a is replaced by the 2x2 block
+            [[a.real, -a.imag], [a.imag, a.real]].
+            out is reused if it has the right shape.
+        """
+        real = self.data.real
+        if out is None or (out.l, out.u, out.M, out.data.dtype) != \
+                (2*self.l + 1, 2*self.u + 1, 2*self.M, real.dtype):
+            out = BandedMatrix(2*self.l + 1, 2*self.u + 1, 2*self.M,
+                    real.dtype)
+        # entry (i, j) of self is in the row b=u+i-j of self.data:
+        # its blocks are in the rows 2b, 2b+1, 2b+2 of out.data.
+        out.data[0, ::2] = out.data[-1, 1::2] = 0.
+        out.data[1::2, ::2] = out.data[1::2, 1::2] = real
+        out.data[2::2, ::2] = self.data.imag
+        out.data[:-1:2, 1::2] = -self.data.imag
+        return out
+
+    def record(self) -> None:
+        """
+            remembers the diagonals as the ones of the last solve
+            (for the solves done outside of self.solve).
+        """
+        self.__key, self.__lu = self.data.tobytes(), None
+
+    def unchanged(self) -> bool:
+        """ True if the diagonals are the ones of the last solve """
+        # the raw bytes are an exact and cheap fingerprint:
+        return self.__key is not None and \
+                self.__key == self.data.tobytes()
+
+    def solve(self, f: np.ndarray, overwrite: bool=False,
+            backend: str=None) -> np.ndarray:
+        """
+            returns the solution u of self u = f.
+            LAPACK (?gtsv for tridiagonal matrices, ?gbsv otherwise)
+            is called directly: the buffer is already valid, so the
+            validations of scipy.linalg.solve_banded are skipped
+            (see CHECK_FINITE). If overwrite is True, the buffer
+            can be destroyed by the solve; f is never modified.
+            If the diagonals did not change since the last solve,
+            the factorisation (?gttrf or ?gbtrf) is reused.
+            backend (default: COMPLEX_BACKEND) is used for the
+            complex systems: with "real blocks", they are solved in
+            real arithmetic (see real_blocks).
+        """
+        f = np.asarray(f)
+        assert f.shape[0] == self.M
+        if CHECK_FINITE and not (np.isfinite(self.data).all() and
+                np.isfinite(f).all()):
+            raise ValueError("array must not contain infs or NaNs")
+        if self.M == 1:
+            return f / self.data[self.u]
+        backend = COMPLEX_BACKEND if backend is None else backend
+        assert backend in BACKENDS
+        if backend == "real blocks" and np.iscomplexobj(self.data):
+            self.__blocks = self.real_blocks(out=self.__blocks)
+            rhs = np.empty(2*self.M, dtype=self.__blocks.data.dtype)
+            rhs[::2], rhs[1::2] = f.real, f.imag
+            x = self.__blocks.solve(rhs, overwrite=True)
+            return x[::2] + 1j * x[1::2]
+        if backend == "real blocks" and np.iscomplexobj(f):
+            # real and imaginary parts are two real right-hand sides:
+            x = self.solve(np.stack((f.real, f.imag), axis=-1),
+                    overwrite=overwrite, backend=backend)
+            return x[:, 0] + 1j * x[:, 1]
+        if self.unchanged():
+            return self.__solve_factorised(f)
+        self.record()
+        if self.l == self.u == 1:
+            gtsv = _lapack("gtsv", self.data, f)
+            *_, x, info = gtsv(self.data[2, :-1], self.data[1],
+                    self.data[0, 1:], f, overwrite_dl=overwrite,
+                    overwrite_d=overwrite, overwrite_du=overwrite,
+                    overwrite_b=False)
+        else:
+            gbsv = _lapack("gbsv", self.data, f)
+            # gbsv needs l more rows for the fill-in of the LU:
+            ab = np.zeros((2*self.l + self.u + 1, self.M),
+                    dtype=gbsv.dtype)
+            ab[self.l:] = self.data
+            _, _, x, info = gbsv(self.l, self.u, ab, f, overwrite_ab=True)
+        if info > 0:
+            raise LinAlgError("singular matrix")
+        assert info == 0
+        return x
+
+    def __solve_factorised(self, f: np.ndarray) -> np.ndarray:
+        """
+            solves with the factorisation of the diagonals
+            (computed at the first call after a change).
+        """
+        dtype = np.result_type(self.data, f, np.float32)
+        if self.__lu is None or self.__lu[0] != dtype:
+            self.__lu = (dtype, self.__factorise(dtype))
+        factors = self.__lu[1]
+        if len(factors) == 5: # ?gttrf
+            x, info = _lapack("gttrs", factors[0])(*factors, f)
+        else:
+            lu, ipiv = factors
+            x, info = _lapack("gbtrs", lu)(lu, self.l, self.u, f, ipiv)
+        assert info == 0
+        return x
+
+    def __factorise(self, dtype) -> tuple:
+        """ LU factorisation of self (?gttrf or ?gbtrf) """
+        data = self.data.astype(dtype, copy=False)
+        # (the wrapper of ?gttrf in scipy fails when M=2)
+        if self.l == self.u == 1 and self.M > 2:
+            gttrf = _lapack("gttrf", data)
+            *factors, info = gttrf(data[2, :-1], data[1], data[0, 1:])
+        else:
+            gbtrf = _lapack("gbtrf", data)
+            # gbtrf needs l more rows for the fill-in of the LU:
+            ab = np.zeros((2*self.l + self.u + 1, self.M), dtype=dtype)
+            ab[self.l:] = data
+            *factors, info = gbtrf(ab, self.l, self.u, overwrite_ab=True)
+        if info > 0:
+            raise LinAlgError("singular matrix")
+        assert info == 0
+        return tuple(factors)
+
+def solve_batched(ab: np.ndarray, f: np.ndarray,
+        shape_bands=(1, 1)) -> np.ndarray:
+    """
+        solves the B independent banded systems ab[i] u[i] = f[i]
+        and returns u, of shape (B, M).
+        ab has the shape (B, l+u+1, M) with the layout of
+        BandedMatrix.data and shape_bands=(l, u).
+        Tridiagonal systems are solved in one compiled call
+        (same algorithm as LAPACK ?gtsv), the others one by one.
+    """
+    l, u = shape_bands
+    assert ab.ndim == 3 and ab.shape[1] == l + u + 1
+    assert f.shape == (ab.shape[0], ab.shape[2])
+    dtype = np.result_type(ab, f, np.float64)
+    if CHECK_FINITE and not (np.isfinite(ab).all() and
+            np.isfinite(f).all()):
+        raise ValueError("array must not contain infs or NaNs")
+    if l == u == 1 and ab.shape[2] > 1:
+        # the kernel works in place on copies of the diagonals:
+        x = np.array(f, dtype=dtype)
+        if not _thomas_batched(np.array(ab[:, 2], dtype=dtype),
+                np.array(ab[:, 1], dtype=dtype),
+                np.array(ab[:, 0], dtype=dtype), x):
+            raise LinAlgError("singular matrix")
+        return x
+    ret = np.empty(f.shape, dtype=dtype)
+    for i in range(ab.shape[0]):
+        matrix = BandedMatrix(l, u, ab.shape[2], ab.dtype)
+        matrix.data[:] = ab[i]
+        ret[i] = matrix.solve(f[i], overwrite=True)
+    return ret
+
+def solve_systems(systems, backend: str=None) -> list:
+    """
+        solves the list of systems (BandedMatrix, rhs) with
+        solve_batched if they have the same bands and size
+        and if none of them can reuse a factorisation.
+        With the backend "real blocks" (see BandedMatrix.solve),
+        the systems are solved one by one.
+    """
+    backend = COMPLEX_BACKEND if backend is None else backend
+    shapes = {(matrix.l, matrix.u, matrix.M) for matrix, _ in systems}
+    if len(shapes) > 1 or len(systems) == 1 or \
+            backend != "complex" or \
+            any(matrix.unchanged() for matrix, _ in systems):
+        # the factorisations of unchanged matrices are reused
+        return [matrix.solve(f, backend=backend) for matrix, f in systems]
+    (l, u, _), = shapes
+    ret = list(solve_batched(np.stack([matrix.data
+        for matrix, _ in systems]), np.stack([f for _, f in systems]),
+        shape_bands=(l, u)))
+    for matrix, _ in systems:
+        matrix.record()
+    return ret
+
+@jit(nopython=True)
+def _thomas_batched(dl, d, du, b) -> bool:
+    """
+        Gaussian elimination with partial pivoting of the
+        tridiagonal systems (dl[i], d[i], du[i]) x[i] = b[i],
+        written like LAPACK ?gtsv. dl[i, :-1] is the lower diagonal
+        and du[i, 1:] the upper diagonal (BandedMatrix layout).
+        The solutions are stored in b. Returns False if a system
+        is singular.
+    """
+    B, M = d.shape
+    for i in range(B):
+        l = dl[i, :M-1].copy() # becomes the second upper diagonal
+        diag, up, x = d[i], du[i, 1:].copy(), b[i]
+        for k in range(M-1):
+            if abs(diag[k].real) + abs(diag[k].imag) >= \
+                    abs(l[k].real) + abs(l[k].imag):
+                if diag[k] == 0:
+                    return False
+                fact = l[k] / diag[k]
+                diag[k+1] -= fact * up[k]
+                x[k+1] -= fact * x[k]
+                l[k] = 0.
+            else: # interchange of the rows k and k+1
+                fact = diag[k] / l[k]
+                diag[k] = l[k]
+                temp = diag[k+1]
+                diag[k+1] = up[k] - fact * temp
+                if k < M-2:
+                    l[k] = up[k+1]
+                    up[k+1] = -fact * l[k]
+                else:
+                    l[k] = 0.
+                up[k] = temp
+                temp = x[k]
+                x[k] = x[k+1]
+                x[k+1] = temp - fact * x[k+1]
+        if diag[M-1] == 0:
+            return False
+        x[M-1] /= diag[M-1]
+        x[M-2] = (x[M-2] - up[M-2] * x[M-1]) / diag[M-2]
+        for k in range(M-3, -1, -1):
+            x[k] = (x[k] - up[k] * x[k+1] - l[k] * x[k+2]) / diag[k]
+    return True
+
+def benchmark_backends(sizes=(16, 32, 64, 128, 256, 512),
+        shapes_bands=((1, 1), (1, 2), (2, 1)), number: int=2000) -> dict:
+    """
+        measures the time (in microseconds) of a complex solve
+        like the ones of the simulators (Coriolis on the diagonal,
+        new diagonals at each solve) with each of the BACKENDS.
+        returns {(l, u, M): {backend: time}} and prints the table.
+    """
+    import timeit
+    rng = np.random.default_rng(0)
+    ret = {}
+    print(f"{'bands':>6s} {'M':>5s}" +
+            "".join(f" {backend:>12s}" for backend in BACKENDS))
+    for l, u in shapes_bands:
+        for M in sizes:
+            Y = BandedMatrix(l, u, M, np.complex128)
+            Y.data[:] = rng.random(Y.data.shape)
+            Y.diagonal(0)[:] += l + u + 1j
+            data = np.copy(Y.data)
+            f = rng.random(M) + 1j * rng.random(M)
+            def one_solve(backend):
+                Y.data[:] = data
+                Y.record() # the diagonals "change" at each solve
+                Y.data[0, -1] += 1.
+                return Y.solve(f, overwrite=True, backend=backend)
+            ret[(l, u, M)] = {backend: 1e6 * min(timeit.repeat(
+                lambda: one_solve(backend), number=number, repeat=3)) /
+                number for backend in BACKENDS}
+            print(f"{str((l, u)):>6s} {M:5d}" + "".join(f" {time:12.1f}"
+                for time in ret[(l, u, M)].values()))
+    return ret
+
+_LAPACK_FUNCS = {}
+def _lapack(name: str, *arrays):
+    """
+        LAPACK routine name for the common dtype of arrays
+        (get_lapack_funcs is only called once per dtype).
+    """
+    key = (name,) + tuple(arr.dtype.char for arr in arrays)
+    if key not in _LAPACK_FUNCS:
+        _LAPACK_FUNCS[key], = get_lapack_funcs((name,), arrays)
+    return _LAPACK_FUNCS[key]
 
 
 def solve_linear_tridiag(Y, f):
@@ -107,7 +450,7 @@ def solve_linear_tridiag(Y, f):
         f[0] is the condition on the bottom of the domain
         f[-1] is the condition on top of the domain
         !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-        /!\ f[1:-1] should be equal to f * (hm + hmm1) !
+        /!\\ f[1:-1] should be equal to f * (hm + hmm1) !
         !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
         Y is returned by the functions get_Y and get_Y_star
@@ -142,7 +485,7 @@ def solve_linear_with_ultra_right(Y, f):
         f[0] is the condition on the bottom of the domain
         f[-1] is the condition on top of the domain
         !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
-        /!\ f[1:-1] should be equal to f * (hm + hmm1) !
+        /!\\ f[1:-1] should be equal to f * (hm + hmm1) !
         !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
         Y is returned by the functions get_Y and get_Y_star
@@ -10,7 +10,7 @@ from universal_functions import Businger_et_al_1971 as businger
 from utils_linalg import solve_linear
 import figures_unstable
 from fortran.visu import import_data
-from schwarz_coupler import StateAtm, NumericalSetting, projection
+from schwarz_coupler import StateAtm, NumericalSetting, projections
 from matplotlib.animation import FuncAnimation
 
 DEFAULT_U_STAR = 0.01 * np.sqrt(1024.)
@@ -56,14 +56,11 @@ def forcedOcean(sf_scheme: str):
     dz_theta_0 = np.ones(simulator_oce.M+1) * simulator_oce.N0**2 \
             / simulator_oce.alpha / 9.81
 
-    Q_sw = projection(np.asarray(numer_set.Q_sw), N)
-    Q_lw = projection(np.asarray(numer_set.Q_lw), N)
+    Q_sw, Q_lw, wind_10m, temp_10m, u_star, t_star = projections(N,
+            numer_set.Q_sw, numer_set.Q_lw, atm_state.u_delta,
+            atm_state.t_delta, atm_state.u_star, atm_state.t_star)
     delta_sl = numer_set.delta_sl_o
     sf_scheme = numer_set.sf_scheme_o
-    wind_10m = projection(atm_state.u_delta, N)
-    temp_10m = projection(atm_state.t_delta, N)
-    u_star = projection(atm_state.u_star, N)
-    t_star = projection(atm_state.t_star, N)
 
     if sf_scheme in {"FV free", "FV2"}:
         u_i, phi_i, theta_i, dz_theta_i, u_delta, t_delta = \
@@ -103,12 +100,15 @@ def fig_animForcedOcean():
     ret, z = memoised(forcedOcean, "FV Zeng")
     # ret, z = memoised(constantCoolingForAnimation, "FV free")
     fig, axes = plt.subplots(1, 2)
-    for u, ud in zip(ret["all_u"], ret["u_delta"]):
-        u[-1] = ud
-    for t, td in zip(ret["all_theta"], ret["t_delta"]):
-        t[-1] = td
-    line_u, = axes[0].plot(np.real(ret["all_u"][-1]), z)
-    line_t, = axes[1].plot(ret["all_theta"][-1], z)
+    # the frames of a Trajectory are copies: the surface values
+    # are put in arrays of all the frames.
+    all_u, all_theta = np.array(ret["all_u"]), np.array(ret["all_theta"])
+    N_u, N_theta = min(len(all_u), len(ret["u_delta"])), \
+            min(len(all_theta), len(ret["t_delta"]))
+    all_u[:N_u, -1] = ret["u_delta"][:N_u]
+    all_theta[:N_theta, -1] = ret["t_delta"][:N_theta]
+    line_u, = axes[0].plot(np.real(all_u[-1]), z)
+    line_t, = axes[1].plot(all_theta[-1], z)
     axes[0].set_yscale("symlog", linthresh=0.1)
     axes[1].set_yscale("symlog", linthresh=0.1)
     def init():
@@ -118,11 +118,11 @@ def fig_animForcedOcean():
         axes[1].set_ylim(z[0], z[-1])
         return line_u, line_t
     def update(frame):
-        line_u.set_data(np.real(ret["all_u"][frame]), z)
-        line_t.set_data(ret["all_theta"][frame], z)
+        line_u.set_data(np.real(all_u[frame]), z)
+        line_t.set_data(all_theta[frame], z)
         return line_u, line_t
     ani = FuncAnimation(fig, update,
-            frames=range(0, len(ret["all_u"]), 100),
+            frames=range(0, len(all_u), 100),
                     init_func=init, blit=True)
 
     show_or_save("fig_animForcedOcean")